@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上传文件清理脚本
+删除引用数已归零并超过保留期（STORAGE_CLEANUP_GRACE_SECONDS）的上传文件，建议在夜间定时执行
+
+用法:
+    python cleanup_uploads.py                  按配置的保留期清理
+    python cleanup_uploads.py --grace 3600     只保留引用数归零不到1小时的文件
+"""
+
+import argparse
+import sys
+from wxcloudrun import app
+from wxcloudrun.storage import cleanup_unreferenced_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='清理未被引用的上传文件')
+    parser.add_argument('--grace', type=int, help='引用数归零后的保留时间（秒）')
+    args = parser.parse_args()
+
+    with app.app_context():
+        deleted = cleanup_unreferenced_files(args.grace)
+    print(f"已删除 {deleted} 个未被引用的文件")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(f"\n清理上传文件失败: {e}")
+        sys.exit(1)
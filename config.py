@@ -1,13 +1,20 @@
 import os
 
-# 是否开启debug模式
-DEBUG = True
+# 是否开启debug模式（本地开发时设置 DEBUG=true，生产环境必须关闭）
+DEBUG = os.environ.get('DEBUG', 'false').lower() in ('1', 'true', 'yes')
 
 # 读取数据库环境变量
 username = os.environ.get("MYSQL_USERNAME", 'root')
 password = os.environ.get("MYSQL_PASSWORD", 'Z8DguWnb')
 db_address = os.environ.get("MYSQL_ADDRESS", 'sh-cynosdbmysql-grp-g1viz1sm.sql.tencentcdb.com:25808')
 
+# 只读副本配置（读写分离，未配置时所有查询使用主库）
+# 副本地址，逗号分隔，账号密码与主库相同，例如 10.0.0.2:3306,10.0.0.3:3306
+replica_addresses = [a.strip() for a in os.environ.get('MYSQL_REPLICA_ADDRESSES', '').split(',') if a.strip()]
+# 副本完整连接串，逗号分隔，设置后忽略 MYSQL_REPLICA_ADDRESSES（本地可用SQLite文件模拟副本）
+REPLICA_DATABASE_URIS = [u.strip() for u in os.environ.get('REPLICA_DATABASE_URIS', '').split(',') if u.strip()]
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))  # 写入后该用户读主库的时间（秒），应大于副本延迟
+
 # Session配置
 SECRET_KEY = os.environ.get("SECRET_KEY", 'sk-tuoguan2026')
 
@@ -20,4 +27,121 @@ MINIPROGRAM_APPID = os.environ.get('MINIPROGRAM_APPID', '')
 
 # 文件上传配置
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
-UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', os.path.join(os.path.dirname(__file__), 'uploads'))
+# 存储后端：local（本地 UPLOAD_FOLDER）或 s3（S3兼容对象存储，需要另外 pip install boto3，见 requirements.txt 末尾）
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', '')  # 非AWS时填写，如 http://minio:9000、https://cos.ap-shanghai.myqcloud.com
+S3_REGION = os.environ.get('S3_REGION', '')
+S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY', '')
+S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY', '')
+S3_PUBLIC_BASE_URL = os.environ.get('S3_PUBLIC_BASE_URL', '')  # 桶公开读或配置了CDN时的访问地址，为空时使用预签名下载地址
+S3_DOWNLOAD_URL_EXPIRES = int(os.environ.get('S3_DOWNLOAD_URL_EXPIRES', 3600))  # 预签名下载地址有效期（秒）
+DIRECT_UPLOAD_EXPIRES = int(os.environ.get('DIRECT_UPLOAD_EXPIRES', 600))  # 直传地址有效期（秒）
+# 上传文件发送方式：空（Flask直接发送）、x-accel（nginx X-Accel-Redirect）、x-sendfile（Apache/lighttpd X-Sendfile）
+UPLOADS_OFFLOAD = os.environ.get('UPLOADS_OFFLOAD', '')
+UPLOADS_ACCEL_PREFIX = os.environ.get('UPLOADS_ACCEL_PREFIX', '/protected-uploads/')  # nginx internal location 前缀
+USE_X_SENDFILE = UPLOADS_OFFLOAD == 'x-sendfile'
+RENDITION_WORKERS = int(os.environ.get('RENDITION_WORKERS', 2))  # 图片处理进程数，0表示在请求中同步处理
+RENDITION_THUMB_SIZE = int(os.environ.get('RENDITION_THUMB_SIZE', 320))  # 缩略图最长边（像素）
+RENDITION_MEDIUM_SIZE = int(os.environ.get('RENDITION_MEDIUM_SIZE', 1280))  # 中图最长边（像素）
+STORAGE_CLEANUP_GRACE_SECONDS = int(os.environ.get('STORAGE_CLEANUP_GRACE_SECONDS', 86400))  # 引用数归零后保留多久才清理（秒）
+
+# 通知发件箱分发配置
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 4))  # 并发发送线程数
+NOTIFY_BATCH_SIZE = int(os.environ.get('NOTIFY_BATCH_SIZE', 20))  # 每次认领的消息数
+NOTIFY_POLL_INTERVAL = float(os.environ.get('NOTIFY_POLL_INTERVAL', 5))  # 空闲时轮询间隔（秒）
+NOTIFY_LOCK_SECONDS = int(os.environ.get('NOTIFY_LOCK_SECONDS', 60))  # 认领后的锁定时长（秒）
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 5))  # 最大发送次数
+NOTIFY_RETRY_BASE_SECONDS = float(os.environ.get('NOTIFY_RETRY_BASE_SECONDS', 10))  # 重试退避基数（秒）
+NOTIFY_RETRY_MAX_SECONDS = float(os.environ.get('NOTIFY_RETRY_MAX_SECONDS', 600))  # 重试退避上限（秒）
+NOTIFY_COALESCE_WINDOW_SECONDS = float(os.environ.get('NOTIFY_COALESCE_WINDOW_SECONDS', 15))  # 接送通知延迟发送时间（秒），期间同一家长的通知合并为一条，0表示不等待
+
+# 微信access_token配置
+WECHAT_TOKEN_REFRESH_AHEAD = int(os.environ.get('WECHAT_TOKEN_REFRESH_AHEAD', 300))  # 提前刷新时间（秒）
+WECHAT_TOKEN_LEASE_SECONDS = int(os.environ.get('WECHAT_TOKEN_LEASE_SECONDS', 15))  # 刷新租约时长（秒）
+WECHAT_TOKEN_WAIT_SECONDS = float(os.environ.get('WECHAT_TOKEN_WAIT_SECONDS', 5))  # 等待其他进程刷新的最长时间（秒）
+
+# 微信接口HTTP连接池配置
+WECHAT_HTTP_POOL_CONNECTIONS = int(os.environ.get('WECHAT_HTTP_POOL_CONNECTIONS', 4))  # 缓存的主机连接池数量
+WECHAT_HTTP_POOL_MAXSIZE = int(os.environ.get('WECHAT_HTTP_POOL_MAXSIZE', 20))  # 每个主机保持的最大连接数
+WECHAT_HTTP_CONNECT_TIMEOUT = float(os.environ.get('WECHAT_HTTP_CONNECT_TIMEOUT', 3))  # 建立连接超时（秒）
+WECHAT_HTTP_READ_TIMEOUT = float(os.environ.get('WECHAT_HTTP_READ_TIMEOUT', 10))  # 读取响应超时（秒）
+
+# 微信接口熔断和限流配置（按进程计数，多进程、多容器部署时按微信总配额均分）
+WECHAT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('WECHAT_BREAKER_FAILURE_THRESHOLD', 5))  # 连续失败多少次后熔断
+WECHAT_BREAKER_RECOVERY_SECONDS = float(os.environ.get('WECHAT_BREAKER_RECOVERY_SECONDS', 30))  # 熔断后多少秒放行探测请求
+WECHAT_BREAKER_HALF_OPEN_CALLS = int(os.environ.get('WECHAT_BREAKER_HALF_OPEN_CALLS', 1))  # 半开状态同时放行的探测请求数
+WECHAT_THROTTLE_PAUSE_SECONDS = float(os.environ.get('WECHAT_THROTTLE_PAUSE_SECONDS', 60))  # 微信返回45011后暂停调用的时间（秒）
+WECHAT_TEMPLATE_RATE_PER_MINUTE = float(os.environ.get('WECHAT_TEMPLATE_RATE_PER_MINUTE', 600))  # 模板消息每分钟发送上限
+WECHAT_TEMPLATE_RATE_BURST = int(os.environ.get('WECHAT_TEMPLATE_RATE_BURST', 20))  # 模板消息突发上限
+WECHAT_LOGIN_RATE_PER_MINUTE = float(os.environ.get('WECHAT_LOGIN_RATE_PER_MINUTE', 600))  # 小程序登录每分钟调用上限
+WECHAT_LOGIN_RATE_BURST = int(os.environ.get('WECHAT_LOGIN_RATE_BURST', 50))  # 小程序登录突发上限
+WECHAT_LOGIN_MAX_WAIT = float(os.environ.get('WECHAT_LOGIN_MAX_WAIT', 1))  # 登录限流时最多等待的秒数，超过直接返回繁忙
+WECHAT_TOKEN_RATE_PER_MINUTE = float(os.environ.get('WECHAT_TOKEN_RATE_PER_MINUTE', 2))  # access_token 每分钟刷新上限
+
+# 分页配置
+PAGE_SIZE_MAX = int(os.environ.get('PAGE_SIZE_MAX', 100))  # 单页最大条数
+
+# 身份缓存配置（openid -> 角色、用户ID、用户信息）
+IDENTITY_CACHE_TTL = float(os.environ.get('IDENTITY_CACHE_TTL', 60))  # 缓存有效期（秒）
+IDENTITY_CACHE_NEGATIVE_TTL = float(os.environ.get('IDENTITY_CACHE_NEGATIVE_TTL', 10))  # 未注册openid的缓存有效期（秒）
+IDENTITY_CACHE_MAX_SIZE = int(os.environ.get('IDENTITY_CACHE_MAX_SIZE', 10000))  # 最大缓存条数
+
+# 小程序会话令牌配置（/api/wechat/login 签发，HMAC签名，校验时不查库）
+SESSION_TOKEN_TTL = int(os.environ.get('SESSION_TOKEN_TTL', 1800))  # 有效期（秒），单个用户的令牌可通过递增 token_version 提前吊销
+SESSION_TOKEN_VERSION = os.environ.get('SESSION_TOKEN_VERSION', '1')  # 修改后所有已签发的令牌立即失效
+
+# JSON编码后端：auto（安装了orjson时使用orjson）、orjson、json
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
+# 响应压缩配置（按 Accept-Encoding 协商 gzip / brotli）
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))  # 小于该字节数的响应不压缩
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))  # gzip压缩级别 1-9
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))  # brotli压缩质量 0-11（安装brotli时生效）
+COMPRESS_MIMETYPES = ['application/json', 'text/html', 'text/csv', 'application/x-ndjson']  # 需要压缩的类型，图片等已压缩内容不处理
+
+# 接送记录导出配置
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))  # 服务端游标每批读取的行数
+
+# 批量导入配置
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 500))  # 每个事务写入的行数
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 500))  # 响应中最多返回的错误条数
+
+# 批量接送配置
+PICKUP_BATCH_MAX_SIZE = int(os.environ.get('PICKUP_BATCH_MAX_SIZE', 100))  # 单次批量接送的最大学生数
+
+# 家长实时推送配置（长轮询 / SSE），连接数上限 PUSH_MAX_CONNECTIONS 见生产服务配置之后
+PUSH_DB_POLL_INTERVAL = float(os.environ.get('PUSH_DB_POLL_INTERVAL', 1))  # 轮询数据库发现其他进程新记录的间隔（秒）
+PUSH_LONG_POLL_TIMEOUT = float(os.environ.get('PUSH_LONG_POLL_TIMEOUT', 25))  # 长轮询最长等待时间（秒），应小于网关和小程序的请求超时
+PUSH_SSE_HEARTBEAT_SECONDS = float(os.environ.get('PUSH_SSE_HEARTBEAT_SECONDS', 15))  # SSE 心跳间隔（秒），防止空闲连接被网关断开
+PUSH_SSE_MAX_DURATION = float(os.environ.get('PUSH_SSE_MAX_DURATION', 300))  # 单个SSE连接的最长时间（秒），到期后客户端带 Last-Event-ID 重连
+
+# 写接口幂等配置（Idempotency-Key 请求头）
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400))  # 成功响应保存时间（秒），期间的重复请求直接返回该响应
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', 60))  # 处理中的锁定时长（秒），超时后视为首次请求已中断
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 5))  # 并发的重复请求等待首次请求完成的最长时间（秒）
+IDEMPOTENCY_CLEANUP_INTERVAL = float(os.environ.get('IDEMPOTENCY_CLEANUP_INTERVAL', 600))  # 每个进程清理过期幂等键的间隔（秒）
+
+# 生产服务配置（gunicorn.conf.py 读取）
+SERVER_BIND = os.environ.get('SERVER_BIND', '0.0.0.0:80')
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 2))  # 工作进程数，1核容器建议2
+SERVER_WORKER_CLASS = os.environ.get('SERVER_WORKER_CLASS', 'gthread')  # sync / gthread / gevent（需安装gevent）
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))  # gthread 每个进程的线程数
+SERVER_WORKER_CONNECTIONS = int(os.environ.get('SERVER_WORKER_CONNECTIONS', 200))  # gevent 每个进程的最大并发连接数
+SERVER_TIMEOUT = int(os.environ.get('SERVER_TIMEOUT', 30))  # 单个请求超时（秒），超时的工作进程会被重启
+SERVER_GRACEFUL_TIMEOUT = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))  # 收到停止信号后等待处理中请求和通知发送完成的时间（秒）
+SERVER_KEEPALIVE = int(os.environ.get('SERVER_KEEPALIVE', 5))  # 长连接保持时间（秒）
+SERVER_MAX_REQUESTS = int(os.environ.get('SERVER_MAX_REQUESTS', 2000))  # 处理多少请求后重启工作进程，0表示不重启
+SERVER_PRELOAD = os.environ.get('SERVER_PRELOAD', 'true').lower() in ('1', 'true', 'yes')  # 主进程预加载应用，fork后共享内存
+
+# 每个进程同时等待的长轮询/SSE连接数上限，达到上限时返回503和 Retry-After。
+# gthread/sync 模式下每个等待连接占用一个线程：默认只给等待连接一半线程，且至少留一个线程处理普通接口；
+# gevent 模式下等待连接只占协程，默认为 SERVER_WORKER_CONNECTIONS 的一半
+PUSH_MAX_CONNECTIONS = int(os.environ.get(
+    'PUSH_MAX_CONNECTIONS',
+    SERVER_WORKER_CONNECTIONS // 2 if SERVER_WORKER_CLASS == 'gevent' else SERVER_THREADS // 2
+))
+if SERVER_WORKER_CLASS != 'gevent':
+    PUSH_MAX_CONNECTIONS = min(PUSH_MAX_CONNECTIONS, SERVER_THREADS - 1)
+PUSH_RETRY_AFTER_SECONDS = int(os.environ.get('PUSH_RETRY_AFTER_SECONDS', 5))  # 连接数达到上限时建议客户端重试的间隔（秒）
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+生产环境 gunicorn 配置
+启动: gunicorn -c gunicorn.conf.py
+配置项见 config.py 中的 SERVER_*
+"""
+
+import gc
+
+import config as app_config
+
+# gevent 需要在导入应用前打补丁，否则预加载时创建的锁、连接不会变为协程友好的版本
+if app_config.SERVER_WORKER_CLASS == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+wsgi_app = 'wxcloudrun:app'
+bind = app_config.SERVER_BIND
+workers = app_config.SERVER_WORKERS
+worker_class = app_config.SERVER_WORKER_CLASS
+threads = app_config.SERVER_THREADS
+worker_connections = app_config.SERVER_WORKER_CONNECTIONS
+timeout = app_config.SERVER_TIMEOUT
+graceful_timeout = app_config.SERVER_GRACEFUL_TIMEOUT
+keepalive = app_config.SERVER_KEEPALIVE
+max_requests = app_config.SERVER_MAX_REQUESTS
+max_requests_jitter = max(app_config.SERVER_MAX_REQUESTS // 10, 0)
+preload_app = app_config.SERVER_PRELOAD
+accesslog = '-'
+errorlog = '-'
+
+
+def pre_fork(server, worker):
+    # 预加载后主进程中的对象移入永久代，子进程的GC不再扫描、改写这些对象，写时复制的内存页得以共享
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # 数据库连接不能跨进程共享，丢弃从主进程继承的连接池（主库和各只读副本）
+    from wxcloudrun import app, db
+    db.get_engine(app).dispose()
+    for bind in app.config.get('SQLALCHEMY_BINDS') or {}:
+        db.get_engine(app, bind=bind).dispose()
+
+
+def post_worker_init(worker):
+    # 工作进程就绪后立即启动通知分发器，补发重启前未完成的消息
+    from wxcloudrun.views import outbox_dispatcher
+    outbox_dispatcher.start()
+
+
+def worker_exit(server, worker):
+    # 优雅退出：处理中的请求已由 graceful_timeout 等待完成，再等待已认领的通知发送完
+    from wxcloudrun.views import outbox_dispatcher
+    outbox_dispatcher.stop(timeout=app_config.SERVER_GRACEFUL_TIMEOUT)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量导入脚本
+从CSV或JSON文件导入学生、家长、教师或家长-学生绑定关系
+
+用法:
+    python import_data.py students students.csv
+    python import_data.py parents parents.json
+    python import_data.py bindings bindings.csv --mode insert
+
+CSV表头 / JSON字段:
+    students: name, student_number, class_name, grade, avatar_url
+    parents:  openid, name, phone
+    teachers: openid, name, phone
+    bindings: parent_openid, student_number, relationship
+"""
+
+import argparse
+import os
+import sys
+import time
+from wxcloudrun import app
+from wxcloudrun.bulk_import import IMPORT_SPECS, IMPORT_MODES, parse_import_file, import_records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量导入')
+    parser.add_argument('kind', choices=sorted(IMPORT_SPECS), help='导入类型')
+    parser.add_argument('path', help='CSV或JSON文件路径')
+    parser.add_argument('--mode', choices=IMPORT_MODES, default='upsert', help='upsert：已存在则更新；insert：已存在的行报错')
+    parser.add_argument('--format', choices=['csv', 'json'], help='文件格式，默认按扩展名判断')
+    args = parser.parse_args()
+
+    file_format = args.format or os.path.splitext(args.path)[1].lower().lstrip('.')
+    with open(args.path, 'rb') as f:
+        records = parse_import_file(f.read(), file_format)
+
+    started = time.monotonic()
+    with app.app_context():
+        result = import_records(args.kind, records, args.mode)
+
+    print(f"共 {result['total']} 条: 新增 {result['created']}，更新 {result['updated']}，失败 {result['failed']}，"
+          f"耗时 {time.monotonic() - started:.1f} 秒")
+    for error in result['errors']:
+        print(f"  第 {error['row']} 条: {error['error']}")
+    return 1 if result['failed'] else 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except Exception as e:
+        print(f"\n批量导入失败: {e}")
+        sys.exit(1)
@@ -8,6 +8,7 @@ import sys
 import hashlib
 from wxcloudrun import app, db
 from wxcloudrun.model import Admin
+from wxcloudrun.migrations import run_migrations
 
 def init_database():
     """初始化数据库"""
@@ -19,6 +20,10 @@ def init_database():
 
         print("数据库表创建成功！")
 
+        # 记录迁移版本（新建的表已包含全部结构，迁移只会补齐缺失的部分）
+        run_migrations(echo=lambda line: None)
+        print("数据库迁移版本已同步")
+
         # 检查是否已存在管理员
         existing_admin = Admin.query.filter_by(username='admin').first()
         if existing_admin:
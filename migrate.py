@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据库迁移脚本
+按版本顺序执行 wxcloudrun/migrations.py 中尚未应用的迁移
+
+用法:
+    python migrate.py              执行全部未应用的迁移
+    python migrate.py --dry-run    只打印将执行的SQL
+    python migrate.py --status     查看迁移状态
+    python migrate.py --target 3   执行到指定版本
+"""
+
+import argparse
+import sys
+from wxcloudrun import app
+from wxcloudrun.migrations import run_migrations, get_migration_status
+
+
+def main():
+    parser = argparse.ArgumentParser(description='数据库迁移')
+    parser.add_argument('--dry-run', action='store_true', help='只打印将执行的SQL，不修改数据库')
+    parser.add_argument('--status', action='store_true', help='查看迁移状态')
+    parser.add_argument('--target', type=int, help='执行到的目标版本')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.status:
+            for version, name, applied in get_migration_status():
+                print(f"{'[已执行]' if applied else '[未执行]'} {version:04d} {name}")
+            return
+
+        executed = run_migrations(target=args.target, dry_run=args.dry_run)
+        if not executed:
+            print("没有需要执行的迁移")
+        elif args.dry_run:
+            print(f"\n[DRY-RUN] 将执行 {len(executed)} 个迁移")
+        else:
+            print(f"\n已执行 {len(executed)} 个迁移")
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(f"\n数据库迁移失败: {e}")
+        sys.exit(1)
@@ -3,41 +3,22 @@
 """
 数据库迁移脚本 - 添加头像字段
 为 parents 和 teachers 表添加 avatar_url 字段
+
+该迁移已纳入版本化迁移（版本 0001），此脚本保留以兼容旧的部署流程，
+新的结构变更请使用 python migrate.py
 """
 
 import sys
-from wxcloudrun import app, db
+from wxcloudrun import app
+from wxcloudrun.migrations import run_migrations
+
 
 def migrate_add_avatar():
     """添加头像字段到家长和教师表"""
     with app.app_context():
         print("开始数据库迁移：添加头像字段...")
+        run_migrations(target=1)
 
-        try:
-            # 为 parents 表添加 avatar_url 字段
-            db.engine.execute(
-                "ALTER TABLE parents ADD COLUMN avatar_url VARCHAR(500) DEFAULT NULL"
-            )
-            print("[OK] parents 表添加 avatar_url 字段成功")
-        except Exception as e:
-            if "Duplicate column name" in str(e) or "duplicate column" in str(e).lower():
-                print("[OK] parents 表的 avatar_url 字段已存在，跳过")
-            else:
-                print(f"[ERROR] parents 表添加字段失败: {e}")
-                raise
-
-        try:
-            # 为 teachers 表添加 avatar_url 字段
-            db.engine.execute(
-                "ALTER TABLE teachers ADD COLUMN avatar_url VARCHAR(500) DEFAULT NULL"
-            )
-            print("[OK] teachers 表添加 avatar_url 字段成功")
-        except Exception as e:
-            if "Duplicate column name" in str(e) or "duplicate column" in str(e).lower():
-                print("[OK] teachers 表的 avatar_url 字段已存在，跳过")
-            else:
-                print(f"[ERROR] teachers 表添加字段失败: {e}")
-                raise
 
 if __name__ == '__main__':
     try:
@@ -1,7 +1,7 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 import pymysql
 import config
+from wxcloudrun.routing import RoutingSQLAlchemy, REPLICA_BIND_PREFIX, init_read_routing
 
 # 因MySQLDB不支持Python3，使用pymysql扩展库代替MySQLDB库
 pymysql.install_as_MySQLdb()
@@ -15,6 +15,11 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql://{}:{}@{}/tuoguan'.format(config
                                                                              config.db_address)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# 只读副本，以 replica_<n> 为键注册为bind，由 wxcloudrun.routing 按查询类型路由
+replica_uris = config.REPLICA_DATABASE_URIS or ['mysql://{}:{}@{}/tuoguan'.format(config.username, config.password, address)
+                                               for address in config.replica_addresses]
+app.config['SQLALCHEMY_BINDS'] = {f'{REPLICA_BIND_PREFIX}{i}': uri for i, uri in enumerate(replica_uris)}
+
 # Session配置
 app.config['SECRET_KEY'] = config.SECRET_KEY
 
@@ -22,10 +27,15 @@ app.config['SECRET_KEY'] = config.SECRET_KEY
 app.config['MAX_CONTENT_LENGTH'] = config.MAX_CONTENT_LENGTH
 
 # 初始化DB操作对象
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
+init_read_routing(app)
 
 # 加载控制器
 from wxcloudrun import views
 
+# 响应压缩
+from wxcloudrun.compression import init_compression
+init_compression(app)
+
 # 加载配置
 app.config.from_object('config')
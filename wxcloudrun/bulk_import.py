@@ -0,0 +1,212 @@
+"""
+批量导入学生、家长、教师和家长-学生绑定关系
+数据先在内存中校验，再按块（IMPORT_CHUNK_SIZE）用一次IN查询解析已有数据，用多行INSERT/UPSERT写入，
+每块一个事务。校验或写入失败的行记录在返回结果的 errors 中，不影响其他行。
+"""
+
+import csv
+import io
+import json
+import logging
+from datetime import datetime
+
+import config
+from wxcloudrun.dao import get_ids_by_keys, get_existing_binding_pairs, bulk_upsert
+from wxcloudrun.model import Student, Parent, Teacher, ParentStudent
+from wxcloudrun.utils import invalidate_identity
+
+logger = logging.getLogger('log')
+
+IMPORT_SPECS = {
+    'students': {
+        'model': Student,
+        'key': 'student_number',
+        'required': ['name', 'student_number', 'class_name'],
+        'optional': ['grade', 'avatar_url'],
+    },
+    'parents': {
+        'model': Parent,
+        'key': 'openid',
+        'required': ['openid'],
+        'optional': ['name', 'phone'],
+    },
+    'teachers': {
+        'model': Teacher,
+        'key': 'openid',
+        'required': ['openid', 'name'],
+        'optional': ['phone'],
+    },
+    'bindings': {
+        'model': ParentStudent,
+        'key': ('parent_openid', 'student_number'),
+        'required': ['parent_openid', 'student_number'],
+        'optional': ['relationship'],
+    },
+}
+
+IMPORT_MODES = ('upsert', 'insert')
+
+# 校验字段长度时，导入字段对应的表字段
+_COLUMN_ALIASES = {'parent_openid': (Parent, 'openid'), 'student_number': (Student, 'student_number')}
+
+
+def parse_import_file(content, file_format):
+    """
+    解析CSV或JSON内容为字典列表
+    JSON 支持数组或 {"records": [...]}
+    :raises ValueError: 格式错误
+    """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8-sig')
+    if file_format == 'csv':
+        return list(csv.DictReader(io.StringIO(content)))
+    if file_format == 'json':
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSON格式错误: {e}")
+        if isinstance(data, dict):
+            data = data.get('records')
+        if not isinstance(data, list) or not all(isinstance(r, dict) for r in data):
+            raise ValueError('JSON内容应为对象数组')
+        return data
+    raise ValueError('文件格式只支持csv或json')
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _max_length(spec, field):
+    model, column = _COLUMN_ALIASES.get(field, (spec['model'], field))
+    return getattr(model.__table__.c[column].type, 'length', None)
+
+
+def _validate(spec, records):
+    """
+    校验并清洗数据
+    :return: (有效行 [(行号, 数据)], 错误列表)
+    """
+    fields = spec['required'] + spec['optional']
+    valid, errors, seen = [], [], set()
+    for index, record in enumerate(records, start=1):
+        cleaned = {}
+        for field in fields:
+            value = record.get(field)
+            value = str(value).strip() if value is not None else ''
+            cleaned[field] = value or None
+
+        missing = [f for f in spec['required'] if not cleaned[f]]
+        if missing:
+            errors.append({'row': index, 'error': f"缺少必填字段: {', '.join(missing)}"})
+            continue
+        too_long = [f for f in fields if cleaned[f] and _max_length(spec, f) and len(cleaned[f]) > _max_length(spec, f)]
+        if too_long:
+            errors.append({'row': index, 'error': f"字段过长: {', '.join(too_long)}"})
+            continue
+
+        key = tuple(cleaned[k] for k in spec['key']) if isinstance(spec['key'], tuple) else cleaned[spec['key']]
+        if key in seen:
+            errors.append({'row': index, 'error': f"文件中重复: {key}"})
+            continue
+        seen.add(key)
+        valid.append((index, cleaned))
+    return valid, errors
+
+
+def _import_chunk(kind, spec, chunk, mode, update_fields, result):
+    model = spec['model']
+    now = datetime.now()
+
+    if kind == 'bindings':
+        parent_ids = get_ids_by_keys(Parent, 'openid', {r['parent_openid'] for _, r in chunk})
+        student_ids = get_ids_by_keys(Student, 'student_number', {r['student_number'] for _, r in chunk})
+        resolved = []
+        for index, record in chunk:
+            if record['parent_openid'] not in parent_ids:
+                result['errors'].append({'row': index, 'error': f"家长不存在: {record['parent_openid']}"})
+            elif record['student_number'] not in student_ids:
+                result['errors'].append({'row': index, 'error': f"学生不存在: {record['student_number']}"})
+            else:
+                resolved.append((index, {
+                    'parent_id': parent_ids[record['parent_openid']],
+                    'student_id': student_ids[record['student_number']],
+                    'relationship': record['relationship'],
+                }))
+        existing = get_existing_binding_pairs([(r['parent_id'], r['student_id']) for _, r in resolved])
+        is_existing = lambda r: (r['parent_id'], r['student_id']) in existing
+        key_columns = ['parent_id', 'student_id']
+        chunk = resolved
+    else:
+        key = spec['key']
+        existing = get_ids_by_keys(model, key, {r[key] for _, r in chunk})
+        is_existing = lambda r: r[key] in existing
+        key_columns = [key]
+
+    rows = []
+    for index, record in chunk:
+        if mode == 'insert' and is_existing(record):
+            result['errors'].append({'row': index, 'error': '数据已存在'})
+            continue
+        if not update_fields and is_existing(record):
+            # 只提供了唯一键的行没有可更新的字段，已存在时保持原样
+            result['updated'] += 1
+            continue
+        row = dict(record, created_at=now)
+        if 'updated_at' in model.__table__.c:
+            row['updated_at'] = now
+        rows.append((index, row))
+
+    update_columns = [] if mode == 'insert' else list(update_fields)
+    if update_columns and 'updated_at' in model.__table__.c:
+        update_columns.append('updated_at')
+    try:
+        bulk_upsert(model, [row for _, row in rows], key_columns, update_columns)
+    except Exception as e:
+        result['errors'].extend({'row': index, 'error': f"写入失败: {e}"} for index, _ in rows)
+        return
+
+    updated = sum(1 for _, row in rows if is_existing(row))
+    result['updated'] += updated
+    result['created'] += len(rows) - updated
+    if kind in ('parents', 'teachers'):
+        for _, row in rows:
+            invalidate_identity(row['openid'])
+
+
+def import_records(kind, records, mode='upsert'):
+    """
+    批量导入
+    :param kind: students / parents / teachers / bindings
+    :param records: 字典列表
+    :param mode: upsert（已存在则更新）或 insert（已存在的行报错）
+    :return: {'total', 'created', 'updated', 'failed', 'errors': [{'row': 第几条数据, 'error': 原因}]}
+    """
+    spec = IMPORT_SPECS[kind]
+    valid, errors = _validate(spec, records)
+    result = {'total': len(records), 'created': 0, 'updated': 0, 'failed': 0, 'errors': errors}
+
+    # 每行只更新自己提供了的字段，未提供的列保留原值：按提供的字段分组，同组的行用同一条UPSERT写入
+    if kind == 'bindings':
+        updatable = spec['optional']
+    else:
+        updatable = [f for f in spec['required'] + spec['optional'] if f != spec['key']]
+    groups = {}
+    for index, record in valid:
+        present = records[index - 1].keys()
+        groups.setdefault(tuple(f for f in updatable if f in present), []).append((index, record))
+
+    for update_fields, group in groups.items():
+        for chunk in _chunks(group, config.IMPORT_CHUNK_SIZE):
+            try:
+                _import_chunk(kind, spec, chunk, mode, update_fields, result)
+            except Exception as e:
+                logger.error(f"批量导入{kind}失败: {e}")
+                result['errors'].extend({'row': index, 'error': f"导入失败: {e}"} for index, _ in chunk)
+
+    result['errors'].sort(key=lambda e: e['row'])
+    result['failed'] = len(result['errors'])
+    result['errors'] = result['errors'][:config.IMPORT_MAX_ERRORS]
+    logger.info(f"批量导入{kind}: 新增{result['created']} 更新{result['updated']} 失败{result['failed']}")
+    return result
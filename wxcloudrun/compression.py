@@ -0,0 +1,65 @@
+import gzip
+
+from flask import request
+
+import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 支持的编码，按优先顺序排列
+SUPPORTED_ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+
+
+def etag_variants(etag):
+    """同一数据各压缩表示的ETag（压缩后的响应在ETag后追加编码名）"""
+    return [etag] + [f"{etag}-{encoding}" for encoding in SUPPORTED_ENCODINGS]
+
+
+def choose_encoding():
+    """根据 Accept-Encoding 选择编码，客户端不支持时返回None"""
+    accept = request.accept_encodings
+    best, best_quality = None, 0
+    for encoding in SUPPORTED_ENCODINGS:
+        quality = accept[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=config.COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=config.COMPRESS_GZIP_LEVEL)
+
+
+def compress_response(response):
+    """after_request 钩子：压缩较大的文本类响应"""
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in config.COMPRESS_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < config.COMPRESS_MIN_SIZE:
+        return response
+
+    encoding = choose_encoding()
+    if not encoding:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
@@ -1,9 +1,14 @@
 import logging
+from datetime import datetime, timedelta
 
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import or_, and_, literal, func, case, select
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.orm import joinedload
 
 from wxcloudrun import db
-from wxcloudrun.model import Counters, Student, Parent, Teacher, Admin, ParentStudent, PickupRecord
+from wxcloudrun.routing import read_only
+from wxcloudrun.model import Counters, Student, Parent, Teacher, Admin, ParentStudent, PickupRecord, \
+    NotificationOutbox, WeChatAccessToken, StoredFile, IdempotencyKey
 
 # 初始化日志
 logger = logging.getLogger('log')
@@ -64,6 +69,35 @@ def update_counterbyid(counter):
         logger.info("update_counterbyid errorMsg= {} ".format(e))
 
 
+# ==================== Pagination ====================
+
+def _paginate_by_id(query, model, limit=None, after_id=None):
+    """按主键的键集分页（WHERE id > after_id ORDER BY id LIMIT n），翻页耗时与页码无关"""
+    if after_id is not None:
+        query = query.filter(model.id > after_id)
+    query = query.order_by(model.id)
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def _paginate_pickup_records(query, limit=None, cursor=None):
+    """
+    按 (pickup_time, id) 倒序的键集分页
+    :param cursor: 上一页最后一条记录的 (pickup_time, id)
+    """
+    if cursor is not None:
+        pickup_time, record_id = cursor
+        query = query.filter(or_(
+            PickupRecord.pickup_time < pickup_time,
+            and_(PickupRecord.pickup_time == pickup_time, PickupRecord.id < record_id)
+        ))
+    query = query.order_by(PickupRecord.pickup_time.desc(), PickupRecord.id.desc())
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
 # ==================== Student DAO ====================
 
 def create_student(student):
@@ -85,28 +119,20 @@ def get_student_by_id(student_id):
         return None
 
 
-def get_student_by_number(student_number):
+def get_students_by_ids(student_ids):
     try:
-        return Student.query.filter_by(student_number=student_number).first()
+        return Student.query.filter(Student.id.in_(student_ids)).all() if student_ids else []
     except Exception as e:
-        logger.error("get_student_by_number error: {}".format(e))
+        logger.error("get_students_by_ids error: {}".format(e))
         return None
 
 
-def get_all_students():
-    try:
-        return Student.query.all()
-    except Exception as e:
-        logger.error("get_all_students error: {}".format(e))
-        return []
-
-
-def get_students_by_class(class_name):
+def get_student_by_number(student_number):
     try:
-        return Student.query.filter_by(class_name=class_name).all()
+        return Student.query.filter_by(student_number=student_number).first()
     except Exception as e:
-        logger.error("get_students_by_class error: {}".format(e))
-        return []
+        logger.error("get_student_by_number error: {}".format(e))
+        return None
 
 
 def update_student(student):
@@ -162,14 +188,6 @@ def get_parent_by_id(parent_id):
         return None
 
 
-def get_all_parents():
-    try:
-        return Parent.query.all()
-    except Exception as e:
-        logger.error("get_all_parents error: {}".format(e))
-        return []
-
-
 def update_parent(parent):
     try:
         db.session.commit()
@@ -209,21 +227,53 @@ def get_teacher_by_id(teacher_id):
         return None
 
 
-def get_all_teachers():
+def update_teacher(teacher):
+    try:
+        db.session.commit()
+        return teacher
+    except Exception as e:
+        db.session.rollback()
+        logger.error("update_teacher error: {}".format(e))
+        raise
+
+
+# ==================== Identity DAO ====================
+
+def get_identities_by_openid(openid):
+    """
+    一次 UNION 查询同时查出 openid 对应的家长和教师身份
+    :return: 行列表（role, id, openid, name, phone, avatar_url, avatar_thumb_url, created_at, token_version），
+             查询失败返回None
+    """
+    def identity_query(model, role):
+        return db.session.query(
+            literal(role).label('role'), model.id, model.openid, model.name,
+            model.phone, model.avatar_url, model.avatar_thumb_url, model.created_at, model.token_version
+        ).filter(model.openid == openid)
+
     try:
-        return Teacher.query.all()
+        return identity_query(Parent, 'parent').union_all(identity_query(Teacher, 'teacher')).all()
     except Exception as e:
-        logger.error("get_all_teachers error: {}".format(e))
-        return []
+        logger.error("get_identities_by_openid error: {}".format(e))
+        return None
 
 
-def update_teacher(teacher):
+def revoke_session_tokens(model, user_id):
+    """
+    递增家长或教师的令牌版本，该用户已签发的会话令牌全部失效
+    :param model: Parent 或 Teacher
+    :return: 用户openid（用于清除身份缓存），用户不存在返回None
+    """
     try:
+        updated = model.query.filter_by(id=user_id) \
+            .update({'token_version': model.token_version + 1}, synchronize_session=False)
         db.session.commit()
-        return teacher
+        if not updated:
+            return None
+        return db.session.query(model.openid).filter_by(id=user_id).scalar()
     except Exception as e:
         db.session.rollback()
-        logger.error("update_teacher error: {}".format(e))
+        logger.error("revoke_session_tokens error: {}".format(e))
         raise
 
 
@@ -262,16 +312,24 @@ def create_parent_student_relation(parent_id, student_id, relationship=None):
         raise
 
 
+@read_only
 def get_students_by_parent_id(parent_id):
     try:
-        relations = ParentStudent.query.filter_by(parent_id=parent_id).all()
-        student_ids = [r.student_id for r in relations]
-        return Student.query.filter(Student.id.in_(student_ids)).all() if student_ids else []
+        return Student.query.join(ParentStudent, ParentStudent.student_id == Student.id) \
+            .filter(ParentStudent.parent_id == parent_id).all()
     except Exception as e:
         logger.error("get_students_by_parent_id error: {}".format(e))
         return []
 
 
+def is_parent_of_student(parent_id, student_id):
+    try:
+        return db.session.query(ParentStudent.id).filter_by(parent_id=parent_id, student_id=student_id).first() is not None
+    except Exception as e:
+        logger.error("is_parent_of_student error: {}".format(e))
+        return False
+
+
 def get_parents_by_student_id(student_id):
     try:
         relations = ParentStudent.query.filter_by(student_id=student_id).all()
@@ -282,6 +340,24 @@ def get_parents_by_student_id(student_id):
         return []
 
 
+def get_parents_by_student_ids(student_ids):
+    """
+    一次查询获取多个学生的家长
+    :return: {student_id: [Parent]}
+    """
+    try:
+        rows = db.session.query(ParentStudent.student_id, Parent) \
+            .join(Parent, Parent.id == ParentStudent.parent_id) \
+            .filter(ParentStudent.student_id.in_(student_ids)).all() if student_ids else []
+        parents = {student_id: [] for student_id in student_ids}
+        for student_id, parent in rows:
+            parents[student_id].append(parent)
+        return parents
+    except Exception as e:
+        logger.error("get_parents_by_student_ids error: {}".format(e))
+        return None
+
+
 def delete_parent_student_relation(parent_id, student_id):
     try:
         relation = ParentStudent.query.filter_by(parent_id=parent_id, student_id=student_id).first()
@@ -298,61 +374,755 @@ def delete_parent_student_relation(parent_id, student_id):
 
 # ==================== PickupRecord DAO ====================
 
-def create_pickup_record(pickup_record):
+def create_pickup_record_with_notifications(pickup_record, build_notifications):
+    """
+    在同一事务中写入接送记录及其通知发件箱消息
+    :param pickup_record: PickupRecord实体
+    :param build_notifications: 回调，参数为已分配ID的记录，返回NotificationOutbox实体列表
+    """
     try:
         db.session.add(pickup_record)
+        db.session.flush()
+        for message in build_notifications(pickup_record):
+            db.session.add(message)
         db.session.commit()
         return pickup_record
     except Exception as e:
         db.session.rollback()
-        logger.error("create_pickup_record error: {}".format(e))
+        logger.error("create_pickup_record_with_notifications error: {}".format(e))
+        raise
+
+
+def create_pickup_records_with_notifications(pickup_records, build_notifications):
+    """
+    在同一事务中批量写入接送记录及其通知发件箱消息
+    :param pickup_records: PickupRecord实体列表
+    :param build_notifications: 回调，参数为已分配ID的记录，返回NotificationOutbox实体列表
+    """
+    try:
+        db.session.add_all(pickup_records)
+        db.session.flush()
+        for pickup_record in pickup_records:
+            db.session.add_all(build_notifications(pickup_record))
+        db.session.commit()
+        return pickup_records
+    except Exception as e:
+        db.session.rollback()
+        logger.error("create_pickup_records_with_notifications error: {}".format(e))
         raise
 
 
+def _pickup_record_query():
+    """接送记录ORM查询（详情、按ID批量查询），学生和教师随记录一次性JOIN加载，避免序列化时逐条懒加载"""
+    return PickupRecord.query.options(
+        joinedload(PickupRecord.student),
+        joinedload(PickupRecord.teacher)
+    )
+
+
+@read_only
 def get_pickup_record_by_id(record_id):
     try:
-        return PickupRecord.query.get(record_id)
+        return _pickup_record_query().get(record_id)
     except Exception as e:
         logger.error("get_pickup_record_by_id error: {}".format(e))
         return None
 
 
-def get_pickup_records_by_student_id(student_id, limit=None):
+@read_only
+def get_pickup_records_by_ids(record_ids):
+    try:
+        records = _pickup_record_query().filter(PickupRecord.id.in_(record_ids)).all() if record_ids else []
+        by_id = {r.id: r for r in records}
+        return [by_id[record_id] for record_id in record_ids if record_id in by_id]
+    except Exception as e:
+        logger.error("get_pickup_records_by_ids error: {}".format(e))
+        return []
+
+
+# ==================== Bulk Import DAO ====================
+
+def get_ids_by_keys(model, key, values):
+    """
+    按自然键批量查询ID（学号、openid等），一次IN查询
+    :return: {键值: id}
+    """
+    if not values:
+        return {}
+    column = getattr(model, key)
+    return {row[0]: row[1] for row in db.session.query(column, model.id).filter(column.in_(list(values))).all()}
+
+
+def get_existing_binding_pairs(pairs):
+    """
+    查询已存在的家长-学生绑定
+    :param pairs: [(parent_id, student_id)]
+    :return: 已存在的 (parent_id, student_id) 集合
+    """
+    if not pairs:
+        return set()
+    parent_ids = {p for p, _ in pairs}
+    student_ids = {s for _, s in pairs}
+    rows = db.session.query(ParentStudent.parent_id, ParentStudent.student_id).filter(
+        ParentStudent.parent_id.in_(parent_ids), ParentStudent.student_id.in_(student_ids)
+    ).all()
+    return {(row[0], row[1]) for row in rows} & set(pairs)
+
+
+def bulk_upsert(model, rows, key_columns, update_columns):
+    """
+    多行 INSERT，唯一键冲突时更新 update_columns（为空时只插入）
+    MySQL 使用 ON DUPLICATE KEY UPDATE，SQLite 使用 ON CONFLICT DO UPDATE，整批在一个事务中提交
+    """
+    if not rows:
+        return
+    table = model.__table__
+    dialect = db.engine.dialect.name
+    try:
+        if not update_columns:
+            stmt = table.insert().values(rows)
+        elif dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            stmt = insert(table).values(rows)
+            stmt = stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update_columns})
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+            stmt = insert(table).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=key_columns,
+                set_={c: stmt.excluded[c] for c in update_columns}
+            )
+        else:
+            raise NotImplementedError("bulk_upsert 不支持的数据库: {}".format(dialect))
+        db.session.execute(stmt)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error("bulk_upsert error: {}".format(e))
+        raise
+
+
+# ==================== Row Queries ====================
+# 列表接口的只读快速路径：只查询序列化所需的列，返回行元组，不构造ORM对象、不进入identity map
+
+_STUDENT_ROW_COLUMNS = (Student.id, Student.name, Student.student_number, Student.class_name,
+                        Student.grade, Student.avatar_url, Student.created_at)
+
+
+def _user_row_columns(model):
+    return model.id, model.openid, model.name, model.phone, model.avatar_url, model.avatar_thumb_url, model.created_at
+
+
+@read_only
+def get_student_rows(class_name=None, limit=None, after_id=None):
     try:
-        query = PickupRecord.query.filter_by(student_id=student_id).order_by(PickupRecord.pickup_time.desc())
-        if limit:
-            query = query.limit(limit)
-        return query.all()
+        query = db.session.query(*_STUDENT_ROW_COLUMNS)
+        if class_name:
+            query = query.filter(Student.class_name == class_name)
+        return _paginate_by_id(query, Student, limit, after_id).all()
     except Exception as e:
-        logger.error("get_pickup_records_by_student_id error: {}".format(e))
+        logger.error("get_student_rows error: {}".format(e))
         return []
 
 
-def get_pickup_records_by_parent_openid(openid, limit=None):
+@read_only
+def get_parent_rows(limit=None, after_id=None):
     try:
-        parent = get_parent_by_openid(openid)
-        if not parent:
-            return []
+        return _paginate_by_id(db.session.query(*_user_row_columns(Parent)), Parent, limit, after_id).all()
+    except Exception as e:
+        logger.error("get_parent_rows error: {}".format(e))
+        return []
 
-        student_ids = [s.id for s in get_students_by_parent_id(parent.id)]
-        if not student_ids:
-            return []
 
-        query = PickupRecord.query.filter(PickupRecord.student_id.in_(student_ids)).order_by(PickupRecord.pickup_time.desc())
-        if limit:
-            query = query.limit(limit)
-        return query.all()
+@read_only
+def get_teacher_rows(limit=None, after_id=None):
+    try:
+        return _paginate_by_id(db.session.query(*_user_row_columns(Teacher)), Teacher, limit, after_id).all()
     except Exception as e:
-        logger.error("get_pickup_records_by_parent_openid error: {}".format(e))
+        logger.error("get_teacher_rows error: {}".format(e))
         return []
 
 
-def get_all_pickup_records(limit=None):
+def _pickup_record_row_query(parent_id=None):
+    """接送记录行（记录、学生、教师列一次查询），学生列以 s_ 为前缀，教师列以 t_ 为前缀"""
+    query = db.session.query(
+        PickupRecord.id, PickupRecord.student_id, PickupRecord.teacher_id, PickupRecord.photo_url,
+        PickupRecord.photo_thumb_url, PickupRecord.photo_medium_url,
+        PickupRecord.photo_full_url,
+        PickupRecord.pickup_time, PickupRecord.notes, PickupRecord.created_at,
+        *[c.label('s_' + c.key) for c in _STUDENT_ROW_COLUMNS],
+        *[c.label('t_' + c.key) for c in _user_row_columns(Teacher)]
+    ).select_from(PickupRecord) \
+        .outerjoin(Student, Student.id == PickupRecord.student_id) \
+        .outerjoin(Teacher, Teacher.id == PickupRecord.teacher_id)
+    if parent_id is not None:
+        query = query.join(ParentStudent, ParentStudent.student_id == PickupRecord.student_id) \
+            .filter(ParentStudent.parent_id == parent_id)
+    return query
+
+
+@read_only
+def get_pickup_record_rows(limit=None, cursor=None, parent_id=None):
+    """
+    接送记录行
+    :param parent_id: 只查询该家长绑定学生的记录：家长的接送记录列表就是这一条查询，
+                      关联表、记录、学生、教师一次JOIN完成，不先查绑定的学生再逐个查记录
+    """
     try:
-        query = PickupRecord.query.order_by(PickupRecord.pickup_time.desc())
-        if limit:
-            query = query.limit(limit)
-        return query.all()
+        return _paginate_pickup_records(_pickup_record_row_query(parent_id), limit, cursor).all()
     except Exception as e:
-        logger.error("get_all_pickup_records error: {}".format(e))
+        logger.error("get_pickup_record_rows error: {}".format(e))
         return []
+
+
+def get_pickup_record_rows_after(parent_id, after_id, limit=100):
+    """
+    家长绑定学生的ID大于 after_id 的接送记录行，按ID升序（实时推送使用，查询主库以便立即看到新记录）
+    查询后结束事务并归还连接：等待期间不占用数据库连接，下次查询使用新的快照
+    """
+    try:
+        rows = _pickup_record_row_query(parent_id).filter(PickupRecord.id > after_id) \
+            .order_by(PickupRecord.id).limit(limit).all()
+        db.session.commit()
+        return rows
+    except Exception as e:
+        db.session.rollback()
+        logger.error("get_pickup_record_rows_after error: {}".format(e))
+        return []
+
+
+def get_max_pickup_record_id():
+    table = PickupRecord.__table__
+    with db.engine.connect() as conn:
+        return conn.execute(select(func.max(table.c.id))).scalar() or 0
+
+
+def get_pickup_record_ids_after(after_id, limit=1000):
+    """
+    ID大于 after_id 的接送记录 (id, student_id)，按ID升序，用于跨进程发现新记录
+    使用独立连接，不受调用方 db.session 事务快照影响
+    """
+    table = PickupRecord.__table__
+    with db.engine.connect() as conn:
+        return conn.execute(
+            select(table.c.id, table.c.student_id).where(table.c.id > after_id).order_by(table.c.id).limit(limit)
+        ).fetchall()
+
+
+def iter_pickup_record_export_rows(start_time, end_time, class_name=None, teacher_id=None, batch_size=1000):
+    """
+    按时间范围分批读取接送记录，用于流式导出
+    使用服务端游标（stream_results），每次只在内存中保留一批行
+    :param start_time: 起始时间（含）
+    :param end_time: 结束时间（不含）
+    :return: 生成器，每次产出一批行
+    """
+    query = db.session.query(
+        PickupRecord.id, PickupRecord.pickup_time,
+        Student.id.label('student_id'), Student.student_number, Student.name.label('student_name'),
+        Student.class_name, Teacher.id.label('teacher_id'), Teacher.name.label('teacher_name'),
+        PickupRecord.photo_url, PickupRecord.notes, PickupRecord.created_at
+    ).select_from(PickupRecord) \
+        .join(Student, Student.id == PickupRecord.student_id) \
+        .join(Teacher, Teacher.id == PickupRecord.teacher_id) \
+        .filter(PickupRecord.pickup_time >= start_time, PickupRecord.pickup_time < end_time)
+    if class_name:
+        query = query.filter(Student.class_name == class_name)
+    if teacher_id:
+        query = query.filter(PickupRecord.teacher_id == teacher_id)
+    statement = query.order_by(PickupRecord.pickup_time, PickupRecord.id).statement
+
+    with db.get_engine_for_read().connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(statement)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+
+# ==================== Data Versions ====================
+# 用于计算 ETag 的数据版本：一次聚合查询得到数量、最大ID和最后修改时间，任何增删改都会让结果变化
+
+@read_only
+def get_students_version(class_name=None):
+    try:
+        query = db.session.query(func.count(Student.id), func.max(Student.id), func.max(Student.updated_at))
+        if class_name:
+            query = query.filter(Student.class_name == class_name)
+        return tuple(query.one())
+    except Exception as e:
+        logger.error("get_students_version error: {}".format(e))
+        return None
+
+
+@read_only
+def get_parent_students_version(parent_id):
+    try:
+        return tuple(db.session.query(
+            func.count(ParentStudent.id), func.max(ParentStudent.id), func.max(Student.updated_at)
+        ).join(Student, Student.id == ParentStudent.student_id)
+            .filter(ParentStudent.parent_id == parent_id).one())
+    except Exception as e:
+        logger.error("get_parent_students_version error: {}".format(e))
+        return None
+
+
+@read_only
+def get_parent_feed_version(parent_id):
+    """家长接送记录的版本：绑定关系、记录、记录中学生和教师信息的变化都会反映出来"""
+    try:
+        return tuple(db.session.query(
+            func.count(func.distinct(ParentStudent.id)), func.max(ParentStudent.id),
+            func.count(PickupRecord.id), func.max(PickupRecord.id),
+            func.max(Student.updated_at), func.max(Teacher.updated_at)
+        ).select_from(ParentStudent)
+            .join(Student, Student.id == ParentStudent.student_id)
+            .outerjoin(PickupRecord, PickupRecord.student_id == ParentStudent.student_id)
+            .outerjoin(Teacher, Teacher.id == PickupRecord.teacher_id)
+            .filter(ParentStudent.parent_id == parent_id).one())
+    except Exception as e:
+        logger.error("get_parent_feed_version error: {}".format(e))
+        return None
+
+
+# ==================== NotificationOutbox DAO ====================
+
+def _outbox_claimable(now):
+    return or_(
+        and_(NotificationOutbox.status == 'pending', NotificationOutbox.next_attempt_at <= now),
+        and_(NotificationOutbox.status == 'sending', NotificationOutbox.locked_until < now)
+    )
+
+
+def claim_outbox_messages(claim_token, batch_size, lock_seconds):
+    """
+    认领一批待发送的通知消息
+    通过带条件的UPDATE抢占，多个容器同时认领时同一条消息只会被一方拿到
+    到期消息带有 coalesce_key 时，同key下尚未到期的待发送消息一并认领，由分发器合并为一条发送
+    :param claim_token: 本次认领的唯一标识
+    :return: 认领成功的消息字典列表
+    """
+    try:
+        now = datetime.now()
+        candidates = db.session.query(NotificationOutbox.id, NotificationOutbox.coalesce_key) \
+            .filter(_outbox_claimable(now)) \
+            .order_by(NotificationOutbox.next_attempt_at) \
+            .limit(batch_size).all()
+        if not candidates:
+            db.session.commit()
+            return []
+        candidate_ids = [row.id for row in candidates]
+        coalesce_keys = list({row.coalesce_key for row in candidates if row.coalesce_key})
+
+        claimable = _outbox_claimable(now)
+        if coalesce_keys:
+            claimable = or_(claimable, and_(NotificationOutbox.status == 'pending',
+                                            NotificationOutbox.coalesce_key.in_(coalesce_keys)))
+            candidate_ids += [row.id for row in db.session.query(NotificationOutbox.id).filter(
+                NotificationOutbox.coalesce_key.in_(coalesce_keys),
+                NotificationOutbox.status == 'pending',
+                NotificationOutbox.id.notin_(candidate_ids)
+            ).limit(batch_size).all()]
+
+        NotificationOutbox.query.filter(
+            NotificationOutbox.id.in_(candidate_ids),
+            claimable
+        ).update({
+            'status': 'sending',
+            'locked_by': claim_token,
+            'locked_until': now + timedelta(seconds=lock_seconds),
+            'attempts': NotificationOutbox.attempts + 1,
+            'updated_at': now
+        }, synchronize_session=False)
+        db.session.commit()
+
+        messages = NotificationOutbox.query.filter(
+            NotificationOutbox.id.in_(candidate_ids),
+            NotificationOutbox.locked_by == claim_token,
+            NotificationOutbox.status == 'sending'
+        ).all()
+        return [{
+            'id': m.id,
+            'openid': m.openid,
+            'template_id': m.template_id,
+            'payload': m.payload,
+            'coalesce_key': m.coalesce_key,
+            'attempts': m.attempts,
+            'claim_token': claim_token
+        } for m in messages]
+    except Exception as e:
+        db.session.rollback()
+        logger.error("claim_outbox_messages error: {}".format(e))
+        return []
+
+
+def renew_outbox_claim(message_ids, claim_token, lock_seconds):
+    """
+    发送前延长认领的锁定时间，避免批次处理较慢时锁过期、被其他容器重新认领后重复发送
+    :return: 仍由本次认领持有的消息数，小于 message_ids 数量说明已有消息被重新认领
+    """
+    try:
+        now = datetime.now()
+        renewed = NotificationOutbox.query.filter(
+            NotificationOutbox.id.in_(message_ids),
+            NotificationOutbox.locked_by == claim_token,
+            NotificationOutbox.status == 'sending'
+        ).update({
+            'locked_until': now + timedelta(seconds=lock_seconds),
+            'updated_at': now
+        }, synchronize_session=False)
+        db.session.commit()
+        return renewed
+    except Exception as e:
+        db.session.rollback()
+        logger.error("renew_outbox_claim error: {}".format(e))
+        return 0
+
+
+def mark_outbox_sent(message_id, claim_token, merged_ids=()):
+    """
+    记录发送成功
+    :param merged_ids: 合并到本条消息一起发送的其他消息，标记为 merged
+    """
+    try:
+        now = datetime.now()
+        values = {
+            'status': 'sent',
+            'sent_at': now,
+            'locked_until': None,
+            'last_error': None,
+            'updated_at': now
+        }
+        NotificationOutbox.query.filter_by(id=message_id, locked_by=claim_token, status='sending') \
+            .update(values, synchronize_session=False)
+        if merged_ids:
+            NotificationOutbox.query.filter(
+                NotificationOutbox.id.in_(merged_ids),
+                NotificationOutbox.locked_by == claim_token,
+                NotificationOutbox.status == 'sending'
+            ).update(dict(values, status='merged'), synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error("mark_outbox_sent error: {}".format(e))
+
+
+def mark_outbox_failed(message_id, claim_token, error, next_attempt_at=None):
+    """
+    记录发送失败
+    :param next_attempt_at: 下次重试时间，为None时标记为最终失败
+    """
+    try:
+        now = datetime.now()
+        values = {
+            'locked_until': None,
+            'last_error': (error or '')[:500],
+            'updated_at': now
+        }
+        if next_attempt_at is None:
+            values['status'] = 'failed'
+        else:
+            values['status'] = 'pending'
+            values['next_attempt_at'] = next_attempt_at
+        NotificationOutbox.query.filter_by(id=message_id, locked_by=claim_token, status='sending') \
+            .update(values, synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error("mark_outbox_failed error: {}".format(e))
+
+
+def defer_outbox_message(message_id, claim_token, next_attempt_at, reason):
+    """
+    推迟发送（熔断或限流拒绝），不计入发送次数
+    :param next_attempt_at: 下次尝试时间
+    """
+    try:
+        now = datetime.now()
+        NotificationOutbox.query.filter_by(id=message_id, locked_by=claim_token, status='sending').update({
+            'status': 'pending',
+            'attempts': NotificationOutbox.attempts - 1,
+            'next_attempt_at': next_attempt_at,
+            'locked_until': None,
+            'last_error': (reason or '')[:500],
+            'updated_at': now
+        }, synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error("defer_outbox_message error: {}".format(e))
+
+
+# ==================== WeChatAccessToken DAO ====================
+# access_token 的读写使用独立连接和事务，不影响调用方 db.session 中未提交的数据
+
+def get_wechat_token(appid):
+    """
+    查询共享的access_token
+    :return: (access_token, expires_at)，不存在时返回None
+    """
+    table = WeChatAccessToken.__table__
+    with db.engine.connect() as conn:
+        row = conn.execute(
+            table.select().where(table.c.appid == appid)
+        ).first()
+    if row is None or not row.access_token:
+        return None
+    return row.access_token, row.expires_at
+
+
+def acquire_wechat_token_lease(appid, owner, lease_seconds):
+    """
+    抢占刷新租约，同一时间只有一个进程能拿到
+    :return: 是否抢占成功
+    """
+    table = WeChatAccessToken.__table__
+    now = datetime.now()
+    lease_until = now + timedelta(seconds=lease_seconds)
+    with db.engine.begin() as conn:
+        result = conn.execute(
+            table.update()
+            .where(table.c.appid == appid)
+            .where(or_(table.c.lease_until.is_(None), table.c.lease_until < now))
+            .values(lease_owner=owner, lease_until=lease_until, updated_at=now)
+        )
+        if result.rowcount == 1:
+            return True
+        exists = conn.execute(table.select().where(table.c.appid == appid)).first()
+    if exists is not None:
+        return False
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(
+                appid=appid, lease_owner=owner, lease_until=lease_until, updated_at=now
+            ))
+        return True
+    except IntegrityError:
+        return False
+
+
+def save_wechat_token(appid, owner, access_token, expires_at):
+    """
+    保存新token并释放租约
+    :return: 是否保存成功（租约已过期并被其他进程抢占时不保存）
+    """
+    table = WeChatAccessToken.__table__
+    with db.engine.begin() as conn:
+        result = conn.execute(
+            table.update()
+            .where(table.c.appid == appid)
+            .where(table.c.lease_owner == owner)
+            .values(access_token=access_token, expires_at=expires_at,
+                    lease_owner=None, lease_until=None, updated_at=datetime.now())
+        )
+    return result.rowcount == 1
+
+
+def release_wechat_token_lease(appid, owner):
+    table = WeChatAccessToken.__table__
+    with db.engine.begin() as conn:
+        conn.execute(
+            table.update()
+            .where(table.c.appid == appid)
+            .where(table.c.lease_owner == owner)
+            .values(lease_owner=None, lease_until=None)
+        )
+
+
+def expire_wechat_token(appid, access_token):
+    """将已失效的token标记为过期（仅当库中仍是该token时）"""
+    table = WeChatAccessToken.__table__
+    with db.engine.begin() as conn:
+        conn.execute(
+            table.update()
+            .where(table.c.appid == appid)
+            .where(table.c.access_token == access_token)
+            .values(expires_at=datetime.now())
+        )
+
+
+# ==================== StoredFile DAO ====================
+# ref_count 为 -1 表示文件正在被清理：清理先把引用数为0的记录标记为 -1，删除文件后再删除记录，
+# 期间不能增加引用，上传相同内容需等待清理完成后重新保存文件
+
+# 清理标记超过该时长仍未删除视为清理进程已中断，可以直接恢复引用
+STORED_FILE_DELETING_TIMEOUT = 60
+
+
+def add_stored_file_refs(path, sha256, size, count=1):
+    """
+    增加文件引用计数，文件首次出现时插入记录
+    :return: 是否成功；文件正在被清理时返回False
+    """
+    table = StoredFile.__table__
+    now = datetime.now()
+    update = table.update().where(table.c.path == path) \
+        .where(or_(table.c.ref_count >= 0,
+                   table.c.updated_at < now - timedelta(seconds=STORED_FILE_DELETING_TIMEOUT))) \
+        .values(ref_count=case((table.c.ref_count >= 0, table.c.ref_count + count), else_=count),
+                renditions_ready=case((table.c.ref_count >= 0, table.c.renditions_ready), else_=False),
+                size=size, updated_at=now)
+    with db.engine.begin() as conn:
+        if conn.execute(update).rowcount == 1:
+            return True
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(
+                path=path, sha256=sha256, size=size, ref_count=count, created_at=now, updated_at=now
+            ))
+        return True
+    except IntegrityError:
+        # 并发上传了相同内容，对方已插入记录；或记录正在被清理
+        with db.engine.begin() as conn:
+            return conn.execute(update).rowcount == 1
+
+
+def get_stored_file(path):
+    table = StoredFile.__table__
+    with db.engine.connect() as conn:
+        return conn.execute(table.select().where(table.c.path == path)).first()
+
+
+def mark_stored_file_renditions_ready(path):
+    """记录文件的衍生版本已全部生成，访问衍生版本时不必再检查存储"""
+    table = StoredFile.__table__
+    with db.engine.begin() as conn:
+        conn.execute(
+            table.update()
+            .where(table.c.path == path)
+            .values(renditions_ready=True)
+        )
+
+
+def release_stored_file_refs(path, count=1):
+    """减少文件引用计数；不是按内容存储的旧文件没有记录，忽略"""
+    table = StoredFile.__table__
+    with db.engine.begin() as conn:
+        conn.execute(
+            table.update()
+            .where(table.c.path == path)
+            .where(table.c.ref_count > 0)
+            .values(ref_count=case((table.c.ref_count > count, table.c.ref_count - count), else_=0),
+                    updated_at=datetime.now())
+        )
+
+
+def get_unreferenced_stored_files(before, limit=500):
+    """查询引用计数为0（或清理中断）且在指定时间之前不再被引用的文件路径"""
+    table = StoredFile.__table__
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            table.select()
+            .where(table.c.ref_count <= 0)
+            .where(table.c.updated_at < before)
+            .order_by(table.c.updated_at)
+            .limit(limit)
+        ).fetchall()
+    return [row.path for row in rows]
+
+
+def mark_stored_file_deleting(path):
+    """
+    把引用计数仍为0的文件记录标记为清理中，此后不能再增加引用
+    :return: 是否标记成功（期间被重新引用则返回False，文件需要保留）
+    """
+    table = StoredFile.__table__
+    with db.engine.begin() as conn:
+        result = conn.execute(
+            table.update()
+            .where(table.c.path == path)
+            .where(table.c.ref_count <= 0)
+            .values(ref_count=-1, updated_at=datetime.now())
+        )
+    return result.rowcount == 1
+
+
+def delete_stored_file_record(path):
+    """文件删除后删除清理中的记录"""
+    table = StoredFile.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.delete().where(table.c.path == path).where(table.c.ref_count == -1))
+
+
+# ==================== IdempotencyKey DAO ====================
+# 幂等键的读写使用独立连接和事务，处理中状态在业务事务开始前对其他请求可见
+
+def acquire_idempotency_key(key, request_hash, lock_seconds, ttl_seconds):
+    """
+    抢占幂等键
+    不存在、已过期或处理方锁已超时的键可以抢占
+    :return: (是否抢占成功, 已有记录)，抢占成功时已有记录为None
+    """
+    table = IdempotencyKey.__table__
+    now = datetime.now()
+    values = dict(request_hash=request_hash, status='in_progress', response_status=None,
+                  response_mimetype=None, response_body=None,
+                  locked_until=now + timedelta(seconds=lock_seconds),
+                  expires_at=now + timedelta(seconds=ttl_seconds), created_at=now)
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(key=key, **values))
+        return True, None
+    except IntegrityError:
+        pass
+    with db.engine.begin() as conn:
+        result = conn.execute(
+            table.update()
+            .where(table.c.key == key)
+            .where(or_(table.c.expires_at < now,
+                       and_(table.c.status == 'in_progress', table.c.locked_until < now)))
+            .values(**values)
+        )
+        if result.rowcount == 1:
+            return True, None
+        return False, conn.execute(table.select().where(table.c.key == key)).first()
+
+
+def get_idempotency_key(key):
+    table = IdempotencyKey.__table__
+    with db.engine.connect() as conn:
+        return conn.execute(table.select().where(table.c.key == key)).first()
+
+
+def complete_idempotency_key(key, request_hash, response_status, response_mimetype, response_body):
+    """保存首次请求的响应（只更新本请求抢占的键）"""
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as conn:
+        conn.execute(
+            table.update()
+            .where(table.c.key == key)
+            .where(table.c.request_hash == request_hash)
+            .where(table.c.status == 'in_progress')
+            .values(status='completed', response_status=response_status, response_mimetype=response_mimetype,
+                    response_body=response_body, locked_until=None)
+        )
+
+
+def release_idempotency_key(key, request_hash):
+    """
+    请求失败时删除幂等键，客户端可以用同一个键重试
+    只删除本请求抢占的键（key 已包含调用者），锁超时后被参数不同的请求重新抢占的键保留
+    """
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as conn:
+        conn.execute(
+            table.delete()
+            .where(table.c.key == key)
+            .where(table.c.request_hash == request_hash)
+            .where(table.c.status == 'in_progress')
+        )
+
+
+def delete_expired_idempotency_keys(limit=1000):
+    """删除已过期的幂等键，返回删除数量"""
+    table = IdempotencyKey.__table__
+    now = datetime.now()
+    with db.engine.begin() as conn:
+        keys = [row.key for row in conn.execute(
+            select(table.c.key).where(table.c.expires_at < now).limit(limit)
+        )]
+        if not keys:
+            return 0
+        conn.execute(table.delete().where(table.c.key.in_(keys)).where(table.c.expires_at < now))
+    return len(keys)
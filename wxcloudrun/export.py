@@ -0,0 +1,51 @@
+import csv
+import io
+
+from wxcloudrun.response import json_dumps
+from wxcloudrun.utils import format_datetime
+
+# 导出字段：(列名, 表头)
+EXPORT_FIELDS = [
+    ('id', '记录ID'),
+    ('pickup_time', '接送时间'),
+    ('student_id', '学生ID'),
+    ('student_number', '学号'),
+    ('student_name', '学生姓名'),
+    ('class_name', '班级'),
+    ('teacher_id', '教师ID'),
+    ('teacher_name', '教师姓名'),
+    ('photo_url', '照片'),
+    ('notes', '备注'),
+    ('created_at', '创建时间'),
+]
+
+DATETIME_FIELDS = ('pickup_time', 'created_at')
+
+
+def _row_values(row):
+    mapping = row._mapping
+    return [format_datetime(mapping[key]) if key in DATETIME_FIELDS else mapping[key] for key, _ in EXPORT_FIELDS]
+
+
+def iter_csv(batches):
+    """
+    逐批生成CSV文本
+    先输出BOM和表头，客户端立即收到首字节；Excel依赖BOM识别UTF-8中文
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([title for _, title in EXPORT_FIELDS])
+    yield '\ufeff' + buffer.getvalue()
+
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(_row_values(row) for row in rows)
+        yield buffer.getvalue()
+
+
+def iter_ndjson(batches):
+    """逐批生成NDJSON，每行一条记录"""
+    keys = [key for key, _ in EXPORT_FIELDS]
+    for rows in batches:
+        yield b''.join(json_dumps(dict(zip(keys, _row_values(row)))) + b'\n' for row in rows)
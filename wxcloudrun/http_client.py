@@ -0,0 +1,69 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+
+class HttpClient:
+    """
+    共享的出站HTTP客户端
+    复用 requests.Session 的连接池，保持长连接，避免每次调用都重新进行TCP+TLS握手。
+    连接池按进程创建，fork出的子进程会重新建立自己的连接。
+    """
+
+    def __init__(self, pool_connections, pool_maxsize, connect_timeout, read_timeout):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._create_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=False,
+            max_retries=0
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+# 所有微信接口调用共用的客户端
+wechat_http = HttpClient(
+    config.WECHAT_HTTP_POOL_CONNECTIONS,
+    config.WECHAT_HTTP_POOL_MAXSIZE,
+    config.WECHAT_HTTP_CONNECT_TIMEOUT,
+    config.WECHAT_HTTP_READ_TIMEOUT
+)
@@ -0,0 +1,161 @@
+"""
+写接口幂等
+客户端在请求头 Idempotency-Key 中携带唯一键（如UUID），网络抖动重试时使用同一个键：
+- 首次请求正常处理，成功的响应与键一起保存 IDEMPOTENCY_TTL_SECONDS
+- 有效期内的重复请求直接返回保存的响应（带 Idempotent-Replayed: true），不再保存照片、写库或发送通知
+- 首次请求仍在处理时，重复请求最多等待 IDEMPOTENCY_WAIT_SECONDS，仍未完成则返回"请求正在处理中"
+- 处理失败（返回错误或抛出异常）时删除键，客户端可以用同一个键重试
+键按调用者隔离，同一个键用于参数不同的请求时返回错误。不带请求头的请求不受影响。
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from functools import wraps
+
+from flask import request, session, make_response, Response
+
+import config
+from wxcloudrun.dao import acquire_idempotency_key, get_idempotency_key, complete_idempotency_key, \
+    release_idempotency_key, delete_expired_idempotency_keys
+from wxcloudrun.response import make_err_response
+
+logger = logging.getLogger('log')
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 100
+
+_cleanup_lock = threading.Lock()
+_last_cleanup = 0
+
+
+def _caller():
+    user = getattr(request, 'current_user', None)
+    if user is not None:
+        return f"{user.role}:{user.id}"
+    if session.get('admin_id'):
+        return f"admin:{session['admin_id']}"
+    return 'anonymous'
+
+
+def _storage_key(client_key):
+    raw = '\n'.join([_caller(), request.method, request.path, client_key])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _request_fingerprint():
+    """请求参数指纹：查询参数、表单字段、上传文件内容或JSON请求体"""
+    digest = hashlib.sha256()
+    for name, value in sorted(request.args.items(multi=True)):
+        digest.update(f"arg:{name}={value}\n".encode('utf-8'))
+    if request.form or request.files:
+        for name, value in sorted(request.form.items(multi=True)):
+            digest.update(f"form:{name}={value}\n".encode('utf-8'))
+        for name, file in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+            digest.update(f"file:{name}={file.filename}\n".encode('utf-8'))
+            for chunk in iter(lambda: file.stream.read(65536), b''):
+                digest.update(chunk)
+            file.stream.seek(0)
+    else:
+        digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def _replay(row):
+    response = Response(row.response_body, status=row.response_status, mimetype=row.response_mimetype)
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def _is_success(response):
+    """只保存成功的响应：HTTP 2xx 且业务码为0"""
+    if not 200 <= response.status_code < 300 or response.is_streamed:
+        return False
+    if response.mimetype != 'application/json':
+        return True
+    data = response.get_json(silent=True)
+    return isinstance(data, dict) and data.get('code') == 0
+
+
+def _maybe_cleanup():
+    """每个进程每隔 IDEMPOTENCY_CLEANUP_INTERVAL 秒顺带清理一批过期的键"""
+    global _last_cleanup
+    now = time.monotonic()
+    if now - _last_cleanup < config.IDEMPOTENCY_CLEANUP_INTERVAL or not _cleanup_lock.acquire(blocking=False):
+        return
+    try:
+        _last_cleanup = now
+        deleted = delete_expired_idempotency_keys()
+        if deleted:
+            logger.info(f"已清理 {deleted} 个过期幂等键")
+    except Exception as e:
+        logger.error(f"清理过期幂等键失败: {e}")
+    finally:
+        _cleanup_lock.release()
+
+
+def _wait_for_completion(key):
+    """
+    等待处理中的首次请求结束
+    :return: (是否已结束, 记录)，首次请求失败删除了键时记录为None
+    """
+    deadline = time.monotonic() + config.IDEMPOTENCY_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(0.2)
+        row = get_idempotency_key(key)
+        if row is None or row.status != 'in_progress':
+            return True, row
+    return False, None
+
+
+def idempotent(f):
+    """
+    写接口幂等装饰器，放在认证装饰器之后（需要 request.current_user 或管理员session区分调用者）
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        client_key = request.headers.get(IDEMPOTENCY_HEADER, '').strip()
+        if not client_key:
+            return f(*args, **kwargs)
+        if len(client_key) > MAX_KEY_LENGTH:
+            return make_err_response(f'{IDEMPOTENCY_HEADER} 长度不能超过{MAX_KEY_LENGTH}')
+
+        key = _storage_key(client_key)
+        request_hash = _request_fingerprint()
+        _maybe_cleanup()
+
+        for _ in range(2):
+            acquired, row = acquire_idempotency_key(key, request_hash, config.IDEMPOTENCY_LOCK_SECONDS,
+                                                    config.IDEMPOTENCY_TTL_SECONDS)
+            if acquired:
+                break
+            if row is not None and row.request_hash != request_hash:
+                return make_err_response(f'{IDEMPOTENCY_HEADER} 已用于其他请求')
+            if row is not None and row.status == 'in_progress':
+                # 并发的重复请求：等待首次请求完成
+                finished, row = _wait_for_completion(key)
+                if not finished:
+                    return make_err_response('请求正在处理中，请稍后重试')
+            if row is not None and row.status == 'completed':
+                return _replay(row)
+            # 首次请求失败后键已删除，重新抢占
+        else:
+            return make_err_response('请求正在处理中，请稍后重试')
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            release_idempotency_key(key, request_hash)
+            raise
+        try:
+            if _is_success(response):
+                complete_idempotency_key(key, request_hash, response.status_code, response.mimetype,
+                                         response.get_data(as_text=True))
+            else:
+                release_idempotency_key(key, request_hash)
+        except Exception as e:
+            logger.error(f"保存幂等键响应失败: {e}")
+        return response
+    return decorated_function
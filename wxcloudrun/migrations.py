@@ -0,0 +1,276 @@
+"""
+数据库版本化迁移
+每个迁移由若干操作组成，操作会先检查当前库结构，已满足时不生成任何SQL，因此迁移可以重复执行。
+已执行的版本记录在 schema_migrations 表中。MySQL 上的加索引、加字段使用 ALGORITHM=INPLACE, LOCK=NONE
+在线执行，不阻塞业务写入。
+"""
+
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import inspect, text, MetaData, Table, Column, Index, ForeignKey, Integer, BigInteger, String, \
+    Text, DateTime
+from sqlalchemy.schema import CreateTable as CreateTableDDL, CreateIndex as CreateIndexDDL
+
+from wxcloudrun import db
+from wxcloudrun.model import SchemaMigration
+
+logger = logging.getLogger('log')
+
+# MySQL 迁移锁名称，防止多个容器同时执行迁移
+MIGRATION_LOCK_NAME = 'tuoguan_schema_migrations'
+
+
+# ==================== 迁移操作 ====================
+
+class AddColumn:
+    """添加字段"""
+
+    def __init__(self, table, column, ddl_type):
+        self.table = table
+        self.column = column
+        self.ddl_type = ddl_type
+
+    def statements(self, conn):
+        inspector = inspect(conn)
+        if inspector.has_table(self.table):
+            if self.column in [c['name'] for c in inspector.get_columns(self.table)]:
+                return []
+        sql = f"ALTER TABLE {self.table} ADD COLUMN {self.column} {self.ddl_type}"
+        if conn.dialect.name == 'mysql':
+            sql += ", ALGORITHM=INPLACE, LOCK=NONE"
+        return [sql]
+
+
+class CreateIndex:
+    """创建索引（MySQL 在线创建）"""
+
+    def __init__(self, table, name, columns, unique=False):
+        self.table = table
+        self.name = name
+        self.columns = columns
+        self.unique = unique
+
+    def statements(self, conn):
+        inspector = inspect(conn)
+        if inspector.has_table(self.table):
+            if self.name in [i['name'] for i in inspector.get_indexes(self.table)]:
+                return []
+        columns = ', '.join(self.columns)
+        unique = 'UNIQUE ' if self.unique else ''
+        if conn.dialect.name == 'mysql':
+            return [f"ALTER TABLE {self.table} ADD {unique}INDEX {self.name} ({columns}), "
+                    f"ALGORITHM=INPLACE, LOCK=NONE"]
+        return [f"CREATE {unique}INDEX {self.name} ON {self.table} ({columns})"]
+
+
+class CreateTable:
+    """按冻结的表结构创建表及其索引"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def statements(self, conn):
+        if inspect(conn).has_table(self.table.name):
+            return []
+        sqls = [str(CreateTableDDL(self.table).compile(dialect=conn.dialect)).strip()]
+        sqls += [str(CreateIndexDDL(index).compile(dialect=conn.dialect)).strip() for index in self.table.indexes]
+        return sqls
+
+
+class Migration:
+    def __init__(self, version, name, operations):
+        self.version = version
+        self.name = name
+        self.operations = operations
+
+    def statements(self, conn):
+        sqls = []
+        for operation in self.operations:
+            sqls += operation.statements(conn)
+        return sqls
+
+
+# ==================== 建表时的表结构 ====================
+# 按迁移发布时的结构冻结，不引用 model.py 中的模型：之后加字段、加索引由新的迁移完成，
+# 新库按顺序执行全部迁移得到的结构与老库逐步升级的结构一致
+
+_metadata = MetaData()
+
+# 只用于解析外键引用，不会被创建
+Table('pickup_records', _metadata, Column('id', Integer, primary_key=True))
+
+NOTIFICATION_OUTBOX_V2 = Table(
+    'notification_outbox', _metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('pickup_record_id', Integer, ForeignKey('pickup_records.id')),
+    Column('openid', String(100), nullable=False),
+    Column('template_id', String(100)),
+    Column('payload', Text, nullable=False),
+    Column('status', String(20), nullable=False),
+    Column('attempts', Integer, nullable=False),
+    Column('next_attempt_at', DateTime, nullable=False),
+    Column('locked_by', String(64)),
+    Column('locked_until', DateTime),
+    Column('last_error', String(500)),
+    Column('sent_at', DateTime),
+    Column('created_at', DateTime, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+    Index('idx_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+)
+
+WECHAT_ACCESS_TOKENS_V3 = Table(
+    'wechat_access_tokens', _metadata,
+    Column('appid', String(64), primary_key=True),
+    Column('access_token', String(512)),
+    Column('expires_at', DateTime),
+    Column('lease_owner', String(64)),
+    Column('lease_until', DateTime),
+    Column('updated_at', DateTime, nullable=False),
+)
+
+STORED_FILES_V5 = Table(
+    'stored_files', _metadata,
+    Column('path', String(255), primary_key=True),
+    Column('sha256', String(64), nullable=False),
+    Column('size', BigInteger, nullable=False),
+    Column('ref_count', Integer, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Column('updated_at', DateTime, nullable=False),
+    Index('idx_stored_files_ref_count', 'ref_count', 'updated_at'),
+)
+
+IDEMPOTENCY_KEYS_V8 = Table(
+    'idempotency_keys', _metadata,
+    Column('key', String(64), primary_key=True),
+    Column('request_hash', String(64), nullable=False),
+    Column('status', String(20), nullable=False),
+    Column('response_status', Integer),
+    Column('response_mimetype', String(100)),
+    Column('response_body', Text(16777215)),
+    Column('locked_until', DateTime),
+    Column('expires_at', DateTime, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Index('idx_idempotency_keys_expires_at', 'expires_at'),
+)
+
+
+# ==================== 迁移列表（按版本号递增追加，已发布的迁移不要修改） ====================
+
+MIGRATIONS = [
+    Migration(1, 'add_avatar_url', [
+        AddColumn('parents', 'avatar_url', 'VARCHAR(500) DEFAULT NULL'),
+        AddColumn('teachers', 'avatar_url', 'VARCHAR(500) DEFAULT NULL'),
+    ]),
+    Migration(2, 'create_notification_outbox', [
+        CreateTable(NOTIFICATION_OUTBOX_V2),
+    ]),
+    Migration(3, 'create_wechat_access_tokens', [
+        CreateTable(WECHAT_ACCESS_TOKENS_V3),
+    ]),
+    Migration(4, 'add_pickup_and_binding_indexes', [
+        CreateIndex('pickup_records', 'idx_pickup_student_time', ['student_id', 'pickup_time']),
+        CreateIndex('pickup_records', 'idx_pickup_teacher_time', ['teacher_id', 'pickup_time']),
+        CreateIndex('pickup_records', 'idx_pickup_time_id', ['pickup_time', 'id']),
+        CreateIndex('parent_student', 'idx_parent_student_student', ['student_id', 'parent_id']),
+    ]),
+    Migration(5, 'create_stored_files', [
+        CreateTable(STORED_FILES_V5),
+    ]),
+    Migration(6, 'add_image_rendition_urls', [
+        AddColumn('pickup_records', 'photo_thumb_url', 'VARCHAR(500) DEFAULT NULL'),
+        AddColumn('pickup_records', 'photo_medium_url', 'VARCHAR(500) DEFAULT NULL'),
+        AddColumn('parents', 'avatar_thumb_url', 'VARCHAR(500) DEFAULT NULL'),
+        AddColumn('teachers', 'avatar_thumb_url', 'VARCHAR(500) DEFAULT NULL'),
+    ]),
+    Migration(7, 'add_outbox_coalesce_key', [
+        AddColumn('notification_outbox', 'coalesce_key', 'VARCHAR(150) DEFAULT NULL'),
+        CreateIndex('notification_outbox', 'idx_outbox_coalesce_key_status', ['coalesce_key', 'status']),
+    ]),
+    Migration(8, 'create_idempotency_keys', [
+        CreateTable(IDEMPOTENCY_KEYS_V8),
+    ]),
+    Migration(9, 'add_stored_file_renditions_ready', [
+        AddColumn('stored_files', 'renditions_ready', 'TINYINT(1) NOT NULL DEFAULT 0'),
+    ]),
+    Migration(10, 'add_user_token_version', [
+        AddColumn('parents', 'token_version', 'INT NOT NULL DEFAULT 0'),
+        AddColumn('teachers', 'token_version', 'INT NOT NULL DEFAULT 0'),
+    ]),
+    Migration(11, 'add_pickup_photo_full_url', [
+        AddColumn('pickup_records', 'photo_full_url', 'VARCHAR(500) DEFAULT NULL'),
+    ]),
+]
+
+
+# ==================== 执行 ====================
+
+@contextmanager
+def _migration_lock(conn):
+    if conn.dialect.name != 'mysql':
+        yield
+        return
+    acquired = conn.execute(text("SELECT GET_LOCK(:name, 60)"), {'name': MIGRATION_LOCK_NAME}).scalar()
+    if acquired != 1:
+        raise RuntimeError('其他进程正在执行数据库迁移')
+    try:
+        yield
+    finally:
+        conn.execute(text("SELECT RELEASE_LOCK(:name)"), {'name': MIGRATION_LOCK_NAME})
+
+
+def get_applied_versions(conn):
+    if not inspect(conn).has_table(SchemaMigration.__tablename__):
+        return set()
+    table = SchemaMigration.__table__
+    return {row.version for row in conn.execute(table.select())}
+
+
+def get_migration_status():
+    """
+    查询迁移状态
+    :return: [(version, name, 是否已执行)]
+    """
+    with db.engine.connect() as conn:
+        applied = get_applied_versions(conn)
+    return [(m.version, m.name, m.version in applied) for m in MIGRATIONS]
+
+
+def run_migrations(target=None, dry_run=False, echo=print):
+    """
+    按版本顺序执行未应用的迁移
+    :param target: 执行到的目标版本（含），None 表示全部
+    :param dry_run: 只输出将执行的SQL，不修改数据库
+    :param echo: 输出函数
+    :return: 本次执行（或将执行）的迁移版本列表
+    """
+    executed = []
+    with db.engine.connect() as conn:
+        with _migration_lock(conn):
+            if not dry_run:
+                SchemaMigration.__table__.create(conn, checkfirst=True)
+            applied = get_applied_versions(conn)
+
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    continue
+                if target is not None and migration.version > target:
+                    break
+
+                sqls = migration.statements(conn)
+                echo(f"-- {migration.version:04d} {migration.name}")
+                for sql in sqls:
+                    echo(sql + ';')
+                if not sqls:
+                    echo("-- 结构已是最新，仅记录版本")
+
+                if not dry_run:
+                    for sql in sqls:
+                        conn.execute(text(sql))
+                    conn.execute(SchemaMigration.__table__.insert().values(
+                        version=migration.version, name=migration.name, applied_at=datetime.now()
+                    ))
+                    logger.info(f"数据库迁移已执行: {migration.version:04d} {migration.name}")
+                executed.append(migration.version)
+    return executed
@@ -38,6 +38,8 @@ class Parent(db.Model):
     name = db.Column(db.String(100))
     phone = db.Column(db.String(20))
     avatar_url = db.Column(db.String(500))
+    avatar_thumb_url = db.Column(db.String(500))
+    token_version = db.Column(db.Integer, nullable=False, default=0)  # 递增后该用户已签发的会话令牌全部失效
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
 
@@ -51,6 +53,8 @@ class Teacher(db.Model):
     name = db.Column(db.String(100), nullable=False)
     phone = db.Column(db.String(20))
     avatar_url = db.Column(db.String(500))
+    avatar_thumb_url = db.Column(db.String(500))
+    token_version = db.Column(db.Integer, nullable=False, default=0)  # 递增后该用户已签发的会话令牌全部失效
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
 
@@ -77,7 +81,10 @@ class ParentStudent(db.Model):
     relationship = db.Column(db.String(50))
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
 
-    __table_args__ = (db.UniqueConstraint('parent_id', 'student_id', name='unique_parent_student'),)
+    __table_args__ = (
+        db.UniqueConstraint('parent_id', 'student_id', name='unique_parent_student'),
+        db.Index('idx_parent_student_student', 'student_id', 'parent_id'),
+    )
 
 
 # 接送记录表
@@ -88,9 +95,101 @@ class PickupRecord(db.Model):
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
     teacher_id = db.Column(db.Integer, db.ForeignKey('teachers.id'), nullable=False)
     photo_url = db.Column(db.String(500), nullable=False)
+    photo_thumb_url = db.Column(db.String(500))
+    photo_medium_url = db.Column(db.String(500))
+    photo_full_url = db.Column(db.String(500))  # 去除EXIF后的原尺寸图，对外展示大图用它而不是原图
     pickup_time = db.Column(db.DateTime, nullable=False, default=datetime.now)
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
 
     student = db.relationship('Student', backref='pickup_records')
     teacher = db.relationship('Teacher', backref='pickup_records')
+
+    __table_args__ = (
+        db.Index('idx_pickup_student_time', 'student_id', 'pickup_time'),
+        db.Index('idx_pickup_teacher_time', 'teacher_id', 'pickup_time'),
+        db.Index('idx_pickup_time_id', 'pickup_time', 'id'),
+    )
+
+
+# 通知发件箱表（与接送记录同一事务写入，由后台分发器异步发送）
+class NotificationOutbox(db.Model):
+    __tablename__ = 'notification_outbox'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    pickup_record_id = db.Column(db.Integer, db.ForeignKey('pickup_records.id'))
+    openid = db.Column(db.String(100), nullable=False)
+    template_id = db.Column(db.String(100))
+    payload = db.Column(db.Text, nullable=False)  # JSON: {'data': 模板数据, 'miniprogram': 跳转信息, 'coalesce': 合并所需信息}
+    coalesce_key = db.Column(db.String(150))  # 相同key的待发送消息合并为一条发送，为空时不合并
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending/sending/sent/merged/failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    locked_by = db.Column(db.String(64))
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.String(500))
+    sent_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        db.Index('idx_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+        db.Index('idx_outbox_coalesce_key_status', 'coalesce_key', 'status'),
+    )
+
+
+# 微信access_token共享表（多进程、多容器共用同一个token，并通过租约保证同一时间只有一方刷新）
+class WeChatAccessToken(db.Model):
+    __tablename__ = 'wechat_access_tokens'
+
+    appid = db.Column(db.String(64), primary_key=True)
+    access_token = db.Column(db.String(512))
+    expires_at = db.Column(db.DateTime)
+    lease_owner = db.Column(db.String(64))
+    lease_until = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+
+# 数据库迁移记录表
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+
+# 上传文件引用计数表（按内容哈希存储，相同内容只保存一份）
+class StoredFile(db.Model):
+    __tablename__ = 'stored_files'
+
+    path = db.Column(db.String(255), primary_key=True)  # 相对上传目录的路径
+    sha256 = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    renditions_ready = db.Column(db.Boolean, nullable=False, default=False)  # 衍生版本是否已全部生成
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        db.Index('idx_stored_files_ref_count', 'ref_count', 'updated_at'),
+    )
+
+
+# 幂等键表（客户端通过 Idempotency-Key 请求头重试写接口时返回首次请求的结果）
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    key = db.Column(db.String(64), primary_key=True)  # sha256(调用者 + 请求方法 + 路径 + 客户端幂等键)
+    request_hash = db.Column(db.String(64), nullable=False)  # 请求参数指纹，同一个键不能用于不同的请求
+    status = db.Column(db.String(20), nullable=False, default='in_progress')  # in_progress/completed
+    response_status = db.Column(db.Integer)
+    response_mimetype = db.Column(db.String(100))
+    response_body = db.Column(db.Text(16777215))
+    locked_until = db.Column(db.DateTime)  # 处理中的锁，超时后视为处理方已崩溃，可被重新抢占
+    expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('idx_idempotency_keys_expires_at', 'expires_at'),
+    )
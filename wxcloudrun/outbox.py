@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+import config
+from wxcloudrun.dao import claim_outbox_messages, renew_outbox_claim, mark_outbox_sent, mark_outbox_failed, \
+    defer_outbox_message
+from wxcloudrun.resilience import CallRejected
+
+logger = logging.getLogger('log')
+
+
+class OutboxDispatcher:
+    """
+    通知发件箱分发器
+    后台线程从 notification_outbox 表认领消息，交给线程池并发发送，失败按指数退避重试。
+    发送被熔断或限流拒绝（CallRejected）时推迟消息且不计入发送次数，并暂停认领直到建议的重试时间。
+    同一次认领中 coalesce_key 相同的消息由 merge_func 合并为一条发送。
+    认领基于数据库条件更新，多个进程/容器可以同时运行分发器；每组消息发送前续期认领，
+    在线程池中排队过久、锁已被其他容器重新认领的消息不再发送。
+    """
+
+    def __init__(self, app, send_func, merge_func=None):
+        """
+        :param app: Flask应用
+        :param send_func: 发送函数，参数为 (openid, template_id, payload字典)，成功返回True，
+                          暂时不能发送时抛出 CallRejected
+        :param merge_func: 合并函数，参数为多条消息的payload字典列表，返回合并后的payload；为None时不合并
+        """
+        self.app = app
+        self.send_func = send_func
+        self.merge_func = merge_func
+        self.workers = config.NOTIFY_WORKERS
+        self.batch_size = config.NOTIFY_BATCH_SIZE
+        self.poll_interval = config.NOTIFY_POLL_INTERVAL
+        self.lock_seconds = config.NOTIFY_LOCK_SECONDS
+        self.max_attempts = config.NOTIFY_MAX_ATTEMPTS
+        self.retry_base = config.NOTIFY_RETRY_BASE_SECONDS
+        self.retry_max = config.NOTIFY_RETRY_MAX_SECONDS
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._pid = None
+        self._paused_until = 0
+        self._due_at = None
+
+    @property
+    def worker_id(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        """启动分发线程（fork后的子进程会重新启动自己的线程）"""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='outbox-sender')
+            self._thread = threading.Thread(target=self._run, name='outbox-dispatcher', daemon=True)
+            self._thread.start()
+            logger.info(f"通知分发器已启动: {self.worker_id}")
+
+    def wake(self, delay=0):
+        """
+        有新消息写入时唤醒分发线程，立即开始发送
+        :param delay: 新消息延迟发送（合并窗口）时传入延迟秒数，到期时再唤醒一次
+        """
+        # 已停止（进程退出中）时不再重新启动，消息留在发件箱中由其他进程发送
+        if self._stopping.is_set() and self._pid == os.getpid():
+            return
+        self.start()
+        if delay > 0:
+            # 稍晚于消息到期时间醒来，避免与数据库时间的微小偏差导致本次认领不到
+            due_at = time.monotonic() + delay + 0.2
+            with self._lock:
+                if self._due_at is None or due_at < self._due_at:
+                    self._due_at = due_at
+        self._wakeup.set()
+
+    def _idle_timeout(self):
+        """空闲等待时长：轮询间隔，有延迟消息即将到期时提前醒来"""
+        with self._lock:
+            if self._due_at is None:
+                return self.poll_interval
+            remaining = self._due_at - time.monotonic()
+            if remaining <= 0:
+                self._due_at = None
+                return 0
+            return min(self.poll_interval, remaining)
+
+    def stop(self, timeout=None):
+        """停止认领新消息，并等待正在发送的消息完成"""
+        # 等待时不能持有 _lock：分发线程退出前还要获取它（_idle_timeout）
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread:
+                return
+            self._stopping.set()
+            self._wakeup.set()
+            thread, executor = self._thread, self._executor
+            self._thread = None
+        thread.join(timeout)
+        executor.shutdown(wait=True)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            # 微信接口熔断或限流期间不认领，避免反复认领后又推迟
+            paused = self._paused_until - time.monotonic()
+            if paused > 0:
+                self._stopping.wait(paused)
+                continue
+            try:
+                claimed = self.drain_once()
+            except Exception as e:
+                logger.error(f"通知分发异常: {e}")
+                claimed = 0
+
+            # 认领满一批说明可能还有积压，继续处理；否则等待唤醒或轮询
+            if claimed < self.batch_size:
+                self._wakeup.wait(self._idle_timeout())
+                self._wakeup.clear()
+
+    def drain_once(self):
+        """认领并发送一批消息，返回认领数量"""
+        claim_token = f"{self.worker_id}:{uuid.uuid4().hex[:12]}"[-64:]
+        with self.app.app_context():
+            messages = claim_outbox_messages(claim_token, self.batch_size, self.lock_seconds)
+        if messages:
+            wait([self._executor.submit(self._deliver, group) for group in self._group(messages)])
+        return len(messages)
+
+    def _group(self, messages):
+        """按 coalesce_key 分组，没有key或不合并时每条消息单独一组"""
+        groups = {}
+        for message in messages:
+            key = message.get('coalesce_key') if self.merge_func else None
+            groups.setdefault(key or ('id', message['id']), []).append(message)
+        return list(groups.values())
+
+    def _retry_delay(self, attempts):
+        delay = min(self.retry_max, self.retry_base * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    def _deliver(self, messages):
+        """发送一组消息（多条时合并为一条），整组按同一结果记录"""
+        with self.app.app_context():
+            message = messages[0]
+            claim_token = message['claim_token']
+            attempts = max(m['attempts'] for m in messages)
+
+            if attempts > self.max_attempts:
+                for m in messages:
+                    mark_outbox_failed(m['id'], claim_token, '超过最大发送次数')
+                return
+
+            # 在线程池中排队期间锁可能已过期并被其他容器重新认领，续期失败的组不发送，避免重复通知
+            if renew_outbox_claim([m['id'] for m in messages], claim_token, self.lock_seconds) < len(messages):
+                logger.info(f"通知消息 {[m['id'] for m in messages]} 已被重新认领，跳过")
+                return
+
+            try:
+                payloads = [json.loads(m['payload']) for m in messages]
+                payload = self.merge_func(payloads) if len(payloads) > 1 else payloads[0]
+                ok = self.send_func(message['openid'], message['template_id'], payload)
+                error = None if ok else '模板消息发送失败'
+            except CallRejected as e:
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                next_attempt_at = datetime.now() + timedelta(seconds=e.retry_after)
+                for m in messages:
+                    defer_outbox_message(m['id'], claim_token, next_attempt_at, str(e))
+                return
+            except Exception as e:
+                ok = False
+                error = f"发送异常: {e}"
+
+            if ok:
+                mark_outbox_sent(message['id'], claim_token, [m['id'] for m in messages[1:]])
+            elif attempts >= self.max_attempts:
+                logger.error(f"通知消息 {[m['id'] for m in messages]} 发送失败，已达最大次数: {error}")
+                for m in messages:
+                    mark_outbox_failed(m['id'], claim_token, error)
+            else:
+                next_attempt_at = datetime.now() + timedelta(seconds=self._retry_delay(attempts))
+                for m in messages:
+                    mark_outbox_failed(m['id'], claim_token, error, next_attempt_at)
@@ -0,0 +1,129 @@
+"""
+接送记录实时推送的进程内发布/订阅
+- 订阅者（家长的长轮询或SSE连接）按学生ID登记，只保存一个 Event，不缓存消息：
+  被唤醒后自行按游标查询新记录，因此每个连接的内存占用固定，与消息数量无关
+- 本进程创建接送记录后直接发布，立即唤醒订阅者
+- 其他进程、容器创建的记录由后台线程轮询数据库发现（只在有订阅者时轮询，每个进程一个线程、一条按主键的查询）
+"""
+
+import logging
+import os
+import threading
+import time
+
+import config
+from wxcloudrun.dao import get_max_pickup_record_id, get_pickup_record_ids_after
+
+logger = logging.getLogger('log')
+
+
+class BrokerFull(Exception):
+    """当前进程的订阅连接数已达上限"""
+
+
+class Subscription:
+    __slots__ = ('student_ids', 'event')
+
+    def __init__(self, student_ids):
+        self.student_ids = frozenset(student_ids)
+        self.event = threading.Event()
+
+    def wait(self, timeout):
+        """等待新记录，返回是否被唤醒"""
+        woken = self.event.wait(timeout)
+        self.event.clear()
+        return woken
+
+
+class PickupBroker:
+    """按学生ID分发接送记录通知的进程内代理，带数据库轮询兜底"""
+
+    def __init__(self, app):
+        self.app = app
+        self.max_subscribers = config.PUSH_MAX_CONNECTIONS
+        self.poll_interval = config.PUSH_DB_POLL_INTERVAL
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._subscribers = {}  # student_id -> set(Subscription)
+        self._count = 0
+        self._last_id = None
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self, student_ids):
+        """
+        登记订阅，使用完毕必须调用 unsubscribe
+        :raises BrokerFull: 连接数达到 PUSH_MAX_CONNECTIONS
+        """
+        subscription = Subscription(student_ids)
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                raise BrokerFull()
+            self._count += 1
+            for student_id in subscription.student_ids:
+                self._subscribers.setdefault(student_id, set()).add(subscription)
+        try:
+            self._ensure_poller()
+        except Exception:
+            self.unsubscribe(subscription)
+            raise
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._count -= 1
+            for student_id in subscription.student_ids:
+                subscribers = self._subscribers.get(student_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[student_id]
+
+    def publish(self, student_ids):
+        """唤醒关注这些学生的订阅者"""
+        with self._lock:
+            woken = set()
+            for student_id in student_ids:
+                woken.update(self._subscribers.get(student_id, ()))
+        for subscription in woken:
+            subscription.event.set()
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': self._count, 'students': len(self._subscribers), 'last_id': self._last_id}
+
+    def _ensure_poller(self):
+        """
+        按需启动数据库轮询线程（fork后的子进程重新启动）
+        起点在调用方线程中同步读取，订阅者随后按游标查询时，此后提交的记录一定会被轮询发现
+        """
+        with self._start_lock:
+            with self._lock:
+                if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                    return
+            last_id = get_max_pickup_record_id()
+            with self._lock:
+                self._pid = os.getpid()
+                self._last_id = last_id
+                self._thread = threading.Thread(target=self._poll, name='pickup-broker-poller', daemon=True)
+                self._thread.start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                # 没有订阅者时停止轮询，下次订阅时从当时的最大ID重新开始
+                if self._count == 0:
+                    self._thread = None
+                    return
+            try:
+                self._poll_once()
+            except Exception as e:
+                logger.error(f"轮询新接送记录失败: {e}")
+
+    def _poll_once(self):
+        with self.app.app_context():
+            rows = get_pickup_record_ids_after(self._last_id)
+        if rows:
+            self._last_id = rows[-1].id
+            self.publish({row.student_id for row in rows})
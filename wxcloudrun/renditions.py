@@ -0,0 +1,227 @@
+"""
+上传图片的衍生版本
+上传后提交到进程池处理：按 EXIF 方向摆正，生成 JPEG 缩略图（thumb）、中图（medium）
+和原尺寸版本（full），衍生版本都不含 EXIF（拍摄位置等隐私信息）。
+原图按内容哈希寻址并长期缓存，处理时不会改写；衍生版本的路径由原图路径确定（<原图路径>.<版本名>.jpg），
+尚未生成时访问会即时生成。
+Pillow 已列入 requirements.txt；未安装时不生成衍生版本，接口只返回原图地址，启动时记录警告。
+"""
+
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+from wxcloudrun.cache import TTLCache
+from wxcloudrun.dao import get_stored_file, mark_stored_file_renditions_ready
+from wxcloudrun.storage import get_storage, path_from_url, url_for_path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger('log')
+
+if Image is None:
+    logger.warning('未安装 Pillow，上传图片不生成缩略图等衍生版本，原图的 EXIF 也不会被去除')
+
+# 版本名 -> (最长边像素，None 为保持原尺寸, JPEG质量)
+RENDITIONS = {
+    'thumb': (config.RENDITION_THUMB_SIZE, 70),
+    'medium': (config.RENDITION_MEDIUM_SIZE, 80),
+    'full': (None, 85),
+}
+
+# 已确认衍生版本齐全的原图路径，文件内容不变，只在进程内记住
+READY_CACHE_TTL = 24 * 3600
+_ready = TTLCache(10000)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def is_available():
+    return Image is not None
+
+
+def rendition_path(path, name):
+    return f"{path}.{name}.jpg"
+
+
+def parse_rendition_path(path):
+    """衍生版本路径拆分为 (原图路径, 版本名)，不是衍生版本返回None"""
+    for name in RENDITIONS:
+        suffix = f".{name}.jpg"
+        if path.endswith(suffix):
+            return path[:-len(suffix)], name
+    return None
+
+
+def rendition_urls(url):
+    """
+    原图URL对应的各衍生版本URL
+    :return: {'thumb': url, 'medium': url, 'full': url}，未安装Pillow或不是上传文件时返回空字典
+    """
+    path = path_from_url(url)
+    if not path or not is_available():
+        return {}
+    return {name: url_for_path(rendition_path(path, name)) for name in RENDITIONS}
+
+
+def _to_rgb(image):
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def derived_paths(path):
+    """原图的所有衍生版本路径"""
+    return [rendition_path(path, name) for name in RENDITIONS]
+
+
+def _save_to_storage(storage, image, path, **params):
+    """先写临时文件再保存到存储，本地存储为原子重命名，读取方不会看到写了一半的文件"""
+    fd, tmp_path = tempfile.mkstemp(dir=storage.tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, **params)
+        storage.put_file(tmp_path, path, 'image/jpeg' if params.get('format') == 'JPEG' else None)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def process_image(path):
+    """
+    生成衍生版本（在进程池中执行，也用于即时生成），原图只读不写
+    :param path: 原图相对存储根目录的路径
+    """
+    storage = get_storage()
+    targets = {name: rendition_path(path, name) for name in RENDITIONS}
+    if all(storage.exists(target) for target in targets.values()):
+        return
+
+    if storage.tmp_dir:
+        os.makedirs(storage.tmp_dir, exist_ok=True)
+    with storage.local_copy(path) as local_path:
+        with Image.open(local_path) as source:
+            image = ImageOps.exif_transpose(source)
+
+    rgb = _to_rgb(image)
+    for name, (max_size, quality) in RENDITIONS.items():
+        rendition = rgb.copy()
+        if max_size:
+            rendition.thumbnail((max_size, max_size))
+        _save_to_storage(storage, rendition, targets[name], format='JPEG', quality=quality,
+                         optimize=True, progressive=True)
+
+
+def _get_executor():
+    """进程池按需创建；fork出的子进程不能复用父进程的进程池，重新创建"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(max_workers=config.RENDITION_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _reset_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+
+
+def _mark_ready(path):
+    """记录衍生版本已生成（stored_files 和进程内缓存）"""
+    _ready.set(path, True, READY_CACHE_TTL)
+    try:
+        mark_stored_file_renditions_ready(path)
+    except Exception as e:
+        logger.error(f"记录衍生版本已生成失败 {path}: {e}")
+
+
+def _on_done(path, executor):
+    def callback(future):
+        error = future.exception()
+        if error is not None:
+            logger.error(f"生成图片衍生版本失败 {path}: {error}")
+            # 工作进程异常退出后进程池不可再用，下次提交时重建
+            if isinstance(error, BrokenProcessPool):
+                _reset_executor(executor)
+            return
+        # 回调在进程池的管理线程中执行，没有应用上下文
+        from wxcloudrun import app
+        with app.app_context():
+            _mark_ready(path)
+    return callback
+
+
+def schedule_renditions(url):
+    """上传完成后提交衍生版本处理任务，不阻塞请求；RENDITION_WORKERS=0 时在当前进程同步处理"""
+    path = path_from_url(url)
+    if not path or not is_available():
+        return
+    try:
+        if config.RENDITION_WORKERS <= 0:
+            process_image(path)
+            _mark_ready(path)
+            return
+        executor = _get_executor()
+        executor.submit(process_image, path).add_done_callback(_on_done(path, executor))
+    except BrokenProcessPool:
+        _reset_executor(executor)
+        logger.error(f"图片处理进程池不可用，稍后访问时即时生成 {path}")
+    except Exception as e:
+        logger.error(f"提交图片衍生版本任务失败 {path}: {e}")
+
+
+def is_rendition_ready(path):
+    """
+    衍生版本是否已生成：只查进程内缓存和 stored_files，不访问存储
+    用于对象存储后端直接重定向前的判断，避免每次访问都向对象存储发 HEAD 请求
+    """
+    parsed = parse_rendition_path(path)
+    if not parsed:
+        return False
+    hit, _ = _ready.get(parsed[0])
+    if hit:
+        return True
+    row = get_stored_file(parsed[0])
+    if row is not None and row.renditions_ready:
+        _ready.set(parsed[0], True, READY_CACHE_TTL)
+        return True
+    return False
+
+
+def ensure_rendition(path):
+    """
+    衍生版本不存在时即时生成（进程池积压或任务丢失时的兜底）
+    :return: 文件是否已存在
+    """
+    parsed = parse_rendition_path(path)
+    if not parsed or not is_available():
+        return False
+    storage = get_storage()
+    if not storage.exists(parsed[0]):
+        return False
+    try:
+        process_image(parsed[0])
+    except Exception as e:
+        logger.error(f"即时生成图片衍生版本失败 {path}: {e}")
+        return False
+    if not storage.exists(path):
+        return False
+    _mark_ready(parsed[0])
+    return True
@@ -0,0 +1,242 @@
+"""
+微信接口调用保护
+每个微信接口一个熔断器和一个令牌桶限流器（按进程独立计数）：
+- 熔断器：连续失败达到阈值后打开，冷却期内直接拒绝调用；冷却结束进入半开，放行少量探测请求，成功后关闭
+- 令牌桶：按每分钟配额匀速放行，保证不超过微信的调用频率限制；微信返回 45011 时暂停该接口一段时间
+被拒绝的调用立即抛出 CallRejected，不占用工作线程等待超时，调用方据此快速失败或稍后重试。
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+logger = logging.getLogger('log')
+
+
+class CallRejected(Exception):
+    """调用被熔断器或限流器拒绝"""
+
+    def __init__(self, endpoint, reason, retry_after):
+        """
+        :param reason: circuit_open / rate_limited
+        :param retry_after: 建议多少秒后重试
+        """
+        super().__init__(f"{endpoint} {reason}, retry after {retry_after:.1f}s")
+        self.endpoint = endpoint
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """熔断器：closed（正常）-> open（拒绝）-> half_open（探测）-> closed"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold, recovery_timeout, half_open_max_calls=1):
+        """
+        :param failure_threshold: 连续失败多少次后打开
+        :param recovery_timeout: 打开后多少秒进入半开
+        :param half_open_max_calls: 半开状态同时放行的探测请求数
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._half_open_calls = 0
+        self.rejected = 0
+        self.opened_count = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._half_open_calls = 0
+        return self._state
+
+    def before_call(self):
+        """调用前检查，不允许调用时抛出 CallRejected"""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and self._half_open_calls < self.half_open_max_calls:
+                self._half_open_calls += 1
+                return
+            self.rejected += 1
+            retry_after = max(0.0, self.recovery_timeout - (time.monotonic() - self._opened_at))
+        raise CallRejected(self.name, 'circuit_open', retry_after or 1.0)
+
+    def cancel_call(self):
+        """before_call 放行后调用并未发出（如被限流器拒绝）：归还半开状态的探测名额"""
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._half_open_calls > 0:
+                self._half_open_calls -= 1
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info(f"微信接口 {self.name} 熔断恢复")
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            state = self._current_state()
+            if state == self.HALF_OPEN or (state == self.CLOSED and self._failures >= self.failure_threshold):
+                self._open()
+
+    def trip(self):
+        """立即打开（如微信返回频率限制）"""
+        with self._lock:
+            self._open()
+
+    def _open(self):
+        if self._state != self.OPEN:
+            logger.error(f"微信接口 {self.name} 熔断打开，{self.recovery_timeout} 秒后放行探测请求")
+            self.opened_count += 1
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self._current_state(),
+                'consecutive_failures': self._failures,
+                'opened_count': self.opened_count,
+                'rejected': self.rejected,
+            }
+
+
+class TokenBucket:
+    """令牌桶限流器：每分钟补充 rate_per_minute 个令牌，最多积攒 burst 个"""
+
+    def __init__(self, name, rate_per_minute, burst):
+        self.name = name
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, max_wait=0):
+        """
+        获取一个令牌，需要等待的时间不超过 max_wait 秒时等待后返回，否则抛出 CallRejected
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self._paused_until - now)
+            if self._tokens < 1:
+                wait = max(wait, (1 - self._tokens) / self.rate if self.rate > 0 else float('inf'))
+            if wait > max_wait:
+                self.rejected += 1
+                raise CallRejected(self.name, 'rate_limited', min(wait, 60.0))
+            # 预先扣除令牌，等待期间其他线程不会拿到同一个令牌
+            self._tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """暂停放行（微信返回频率限制时），并清空积攒的令牌"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'tokens': round(self._tokens, 2),
+                'rate_per_minute': round(self.rate * 60, 2),
+                'paused_for': round(max(0.0, self._paused_until - now), 1),
+                'rejected': self.rejected,
+            }
+
+
+class EndpointGuard:
+    """单个微信接口的熔断器和限流器"""
+
+    def __init__(self, name, rate_per_minute, burst, max_wait=0):
+        """
+        :param max_wait: 令牌不足时最多等待的秒数，超过则拒绝
+        """
+        self.name = name
+        self.max_wait = max_wait
+        self.breaker = CircuitBreaker(name, config.WECHAT_BREAKER_FAILURE_THRESHOLD,
+                                      config.WECHAT_BREAKER_RECOVERY_SECONDS,
+                                      config.WECHAT_BREAKER_HALF_OPEN_CALLS)
+        self.bucket = TokenBucket(name, rate_per_minute, burst)
+
+    @contextmanager
+    def call(self):
+        """
+        保护一次调用：先检查熔断器再获取令牌，被拒绝时抛出 CallRejected
+        被限流器拒绝时归还熔断器的探测名额，否则半开状态会一直占满名额、拒绝后续所有调用
+        块内抛出的异常（超时、连接失败等）记为失败；其余情况由调用方根据返回内容调用
+        record_success / record_failure / throttled
+        """
+        self.breaker.before_call()
+        try:
+            self.bucket.acquire(self.max_wait)
+        except CallRejected:
+            self.breaker.cancel_call()
+            raise
+        try:
+            yield self
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+    def record_success(self):
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.breaker.record_failure()
+
+    def throttled(self):
+        """微信返回 45011 等频率限制：暂停限流器并打开熔断器"""
+        logger.error(f"微信接口 {self.name} 触发频率限制，暂停 {config.WECHAT_THROTTLE_PAUSE_SECONDS} 秒")
+        self.bucket.pause(config.WECHAT_THROTTLE_PAUSE_SECONDS)
+        self.breaker.trip()
+
+    def stats(self):
+        return {'breaker': self.breaker.stats(), 'limiter': self.bucket.stats()}
+
+
+# 各微信接口的保护，配额为单个进程的配额（多进程、多容器部署时按总配额均分）
+wechat_guards = {
+    'token': EndpointGuard('token', config.WECHAT_TOKEN_RATE_PER_MINUTE, 1, max_wait=0),
+    'jscode2session': EndpointGuard('jscode2session', config.WECHAT_LOGIN_RATE_PER_MINUTE,
+                                    config.WECHAT_LOGIN_RATE_BURST, max_wait=config.WECHAT_LOGIN_MAX_WAIT),
+    'template_send': EndpointGuard('template_send', config.WECHAT_TEMPLATE_RATE_PER_MINUTE,
+                                   config.WECHAT_TEMPLATE_RATE_BURST, max_wait=0),
+}
+
+
+def get_wechat_guard(name):
+    return wechat_guards[name]
+
+
+def wechat_guard_stats():
+    return {name: guard.stats() for name, guard in wechat_guards.items()}
@@ -2,17 +2,43 @@ import json
 
 from flask import Response
 
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps_stdlib(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _select_json_backend(name):
+    """
+    选择JSON编码后端
+    orjson 与标准库（ensure_ascii=False、紧凑分隔符）对本项目的响应数据输出完全相同的字节
+    """
+    if name == 'json' or (name == 'auto' and orjson is None):
+        return _json_dumps_stdlib
+    if orjson is None:
+        raise RuntimeError('JSON_BACKEND=orjson 但未安装 orjson')
+    return orjson.dumps
+
+
+json_dumps = _select_json_backend(config.JSON_BACKEND)
+
 
 def make_succ_empty_response():
-    data = json.dumps({'code': 0, 'data': {}})
+    data = json_dumps({'code': 0, 'data': {}})
     return Response(data, mimetype='application/json')
 
 
 def make_succ_response(data):
-    data = json.dumps({'code': 0, 'data': data})
+    data = json_dumps({'code': 0, 'data': data})
     return Response(data, mimetype='application/json')
 
 
 def make_err_response(err_msg):
-    data = json.dumps({'code': -1, 'errorMsg': err_msg})
+    data = json_dumps({'code': -1, 'errorMsg': err_msg})
     return Response(data, mimetype='application/json')
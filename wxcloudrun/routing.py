@@ -0,0 +1,130 @@
+"""
+读写分离
+标记为 @read_only 的DAO查询发往只读副本，其余查询和所有写入使用主库。
+副本以 replica_<n> 为键配置在 SQLALCHEMY_BINDS 中，未配置副本时全部使用主库。
+
+写后读一致：请求中发生过写入后，该请求剩余的查询都使用主库；并在 READ_YOUR_WRITES_SECONDS 内
+让同一用户的后续请求也使用主库（进程内按用户记录，并通过 Cookie 跨进程、跨实例传递），
+避免刚提交接送记录的教师在副本同步前看不到自己的记录。
+跨进程只依赖 Cookie：不保存 Cookie 的客户端（如小程序 wx.request 默认不带 Cookie）的后续请求
+落到其他进程或实例时仍可能读副本，这类客户端应在写入后直接使用写接口的返回结果。
+"""
+
+import random
+import threading
+import time
+from functools import wraps
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+
+import config
+from wxcloudrun.cache import TTLCache
+
+REPLICA_BIND_PREFIX = 'replica_'
+STICKY_COOKIE_NAME = 'db_primary_until'
+
+_local = threading.local()
+# 最近写入过的用户 -> 在此之前读主库
+sticky_users = TTLCache(config.IDENTITY_CACHE_MAX_SIZE)
+
+
+def read_only(f):
+    """标记DAO函数只读，其中的查询可以发往副本"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        _local.read_only = getattr(_local, 'read_only', 0) + 1
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _local.read_only -= 1
+    return wrapper
+
+
+def _sticky_key():
+    user = getattr(request, 'current_user', None)
+    if user is not None:
+        return f"{user.role}:{user.id}"
+    if session.get('admin_id'):
+        return f"admin:{session['admin_id']}"
+    return None
+
+
+def _must_use_primary():
+    """当前请求是否需要读主库"""
+    if not has_request_context():
+        return False
+    if g.get('db_wrote'):
+        return True
+    try:
+        if float(request.cookies.get(STICKY_COOKIE_NAME, 0)) > time.time():
+            return True
+    except ValueError:
+        pass
+    key = _sticky_key()
+    return key is not None and sticky_users.get(key)[0]
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if getattr(_local, 'read_only', 0) and not self._flushing and not _must_use_primary():
+            engine = self.db.get_read_engine(self.app)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """支持只读副本的 SQLAlchemy"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def replica_bind_keys(self, app=None):
+        app = self.get_app(app)
+        return [key for key in (app.config.get('SQLALCHEMY_BINDS') or {}) if key.startswith(REPLICA_BIND_PREFIX)]
+
+    def get_read_engine(self, app=None):
+        """随机选择一个副本，未配置副本返回None"""
+        keys = self.replica_bind_keys(app)
+        if not keys:
+            return None
+        return self.get_engine(app, bind=random.choice(keys))
+
+    def get_engine_for_read(self, app=None):
+        """引擎级只读查询（如流式导出）使用的引擎：副本优先，需要写后读一致时使用主库"""
+        engine = None if _must_use_primary() else self.get_read_engine(app)
+        return engine or self.get_engine(app)
+
+
+def _mark_write(*args):
+    if has_request_context():
+        g.db_wrote = True
+
+
+def _mark_statement_write(orm_execute_state):
+    """session.execute 执行的批量写入（bulk_upsert、query.update 等）不经过flush，单独标记"""
+    if not orm_execute_state.is_select:
+        _mark_write()
+
+
+def _remember_write(response):
+    """写入过的请求：记录用户并下发 Cookie，READ_YOUR_WRITES_SECONDS 内的后续请求读主库"""
+    if g.get('db_wrote') and config.READ_YOUR_WRITES_SECONDS > 0:
+        key = _sticky_key()
+        if key is not None:
+            sticky_users.set(key, True, config.READ_YOUR_WRITES_SECONDS)
+        response.set_cookie(STICKY_COOKIE_NAME, str(int(time.time() + config.READ_YOUR_WRITES_SECONDS) + 1),
+                            max_age=int(config.READ_YOUR_WRITES_SECONDS) + 1, httponly=True)
+    return response
+
+
+def init_read_routing(app):
+    event.listen(RoutingSession, 'after_flush', _mark_write)
+    event.listen(RoutingSession, 'do_orm_execute', _mark_statement_write)
+    app.after_request(_remember_write)
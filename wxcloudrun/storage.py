@@ -0,0 +1,431 @@
+"""
+上传文件存储
+- 按内容寻址：上传时边读边计算 sha256 并写入临时文件，再保存为 <目录>/<哈希前2位>/<哈希3-4位>/<哈希><扩展名>，
+  相同内容只保存一份
+- 直传：客户端先申请预签名上传地址，把文件直接上传到存储，再用对象key调用业务接口，文件不经过应用进程
+- stored_files 表记录每个文件被引用的次数，引用数归零一段时间后才会被清理
+- 存储后端由 STORAGE_BACKEND 选择：local（本地目录）或 s3（S3兼容对象存储，如 COS、OSS、MinIO）
+对外的文件地址始终是 /uploads/<路径>，与后端无关，切换后端不需要改数据。
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+import config
+from wxcloudrun.dao import add_stored_file_refs, release_stored_file_refs, get_unreferenced_stored_files, \
+    mark_stored_file_deleting, delete_stored_file_record, get_stored_file, STORED_FILE_DELETING_TIMEOUT
+
+logger = logging.getLogger('log')
+
+ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif'}
+CONTENT_TYPES = {'.jpg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif'}
+URL_PREFIX = '/uploads/'
+CHUNK_SIZE = 64 * 1024
+UPLOAD_FOLDERS = ('pickup_photos', 'avatars')
+# 直传文件的目录，key 为 <目录>/direct/<随机名><扩展名>
+DIRECT_UPLOAD_DIR = 'direct'
+
+
+# ==================== 存储后端 ====================
+
+class StorageBackend:
+    """存储后端接口，path 均为相对存储根目录的路径（即对象key）"""
+
+    # 写入前的临时文件目录，None 表示系统临时目录
+    tmp_dir = None
+
+    def exists(self, path):
+        raise NotImplementedError
+
+    def size(self, path):
+        """文件字节数，不存在返回None"""
+        raise NotImplementedError
+
+    def put_file(self, local_path, path, content_type=None):
+        """把本地临时文件保存到 path（本地后端会移走临时文件）"""
+        raise NotImplementedError
+
+    @contextmanager
+    def local_copy(self, path):
+        """以本地文件的形式读取，用于图片处理"""
+        raise NotImplementedError
+
+    def delete(self, path):
+        raise NotImplementedError
+
+    def presign_upload(self, path, content_type, max_size, expires_in):
+        """
+        生成直传地址，客户端以 multipart/form-data POST 到 url，表单包含 fields 及文件字段 file
+        :return: {'url': 上传地址, 'fields': 表单字段}
+        """
+        raise NotImplementedError
+
+    def download_url(self, path):
+        """文件的直接下载地址，None 表示由应用的 /uploads 路由发送"""
+        return None
+
+
+class LocalStorage(StorageBackend):
+    """本地目录存储（容器重建后数据丢失，只适合单机或挂载了持久卷的部署）"""
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, '.tmp')
+        self._serializer = URLSafeTimedSerializer(config.SECRET_KEY, salt='direct-upload')
+
+    def full_path(self, path):
+        return os.path.join(self.root, path)
+
+    def exists(self, path):
+        return os.path.isfile(self.full_path(path))
+
+    def size(self, path):
+        try:
+            return os.path.getsize(self.full_path(path))
+        except OSError:
+            return None
+
+    def put_file(self, local_path, path, content_type=None):
+        full_path = self.full_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.replace(local_path, full_path)
+
+    @contextmanager
+    def local_copy(self, path):
+        yield self.full_path(path)
+
+    def delete(self, path):
+        try:
+            os.unlink(self.full_path(path))
+        except FileNotFoundError:
+            pass
+
+    def presign_upload(self, path, content_type, max_size, expires_in):
+        # 本地存储没有对象存储的签名上传，由应用的 /api/uploads/direct 接口按签名接收文件，客户端流程一致
+        token = self._serializer.dumps({'key': path, 'content_type': content_type, 'max_size': max_size})
+        return {'url': '/api/uploads/direct', 'fields': {'key': path, 'token': token}}
+
+    def verify_upload_token(self, token, expires_in):
+        """校验直传签名，返回签名内容，无效或过期返回None"""
+        try:
+            return self._serializer.loads(token, max_age=expires_in)
+        except BadSignature:
+            return None
+
+
+class S3Storage(StorageBackend):
+    """S3兼容对象存储，需要安装 boto3"""
+
+    def __init__(self, bucket, endpoint_url=None, region=None, access_key=None, secret_key=None,
+                 public_base_url=None):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError('STORAGE_BACKEND=s3 需要安装 boto3：pip install boto3')
+
+        self.bucket = bucket
+        self.public_base_url = public_base_url.rstrip('/') + '/' if public_base_url else None
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            # 自建 MinIO 等通常不支持虚拟主机风格的桶域名
+            config=Config(signature_version='s3v4', s3={'addressing_style': 'path' if endpoint_url else 'auto'})
+        )
+
+    def _head(self, path):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=path)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, path):
+        return self._head(path) is not None
+
+    def size(self, path):
+        head = self._head(path)
+        return head['ContentLength'] if head else None
+
+    def put_file(self, local_path, path, content_type=None):
+        extra_args = {'CacheControl': 'public, max-age=31536000, immutable'}
+        if content_type:
+            extra_args['ContentType'] = content_type
+        self.client.upload_file(local_path, self.bucket, path, ExtraArgs=extra_args)
+
+    @contextmanager
+    def local_copy(self, path):
+        fd, tmp_path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, path, tmp_path)
+            yield tmp_path
+        finally:
+            os.unlink(tmp_path)
+
+    def delete(self, path):
+        self.client.delete_object(Bucket=self.bucket, Key=path)
+
+    def presign_upload(self, path, content_type, max_size, expires_in):
+        post = self.client.generate_presigned_post(
+            self.bucket, path,
+            Fields={'Content-Type': content_type},
+            Conditions=[{'Content-Type': content_type}, ['content-length-range', 1, max_size]],
+            ExpiresIn=expires_in
+        )
+        return {'url': post['url'], 'fields': post['fields']}
+
+    def download_url(self, path):
+        if self.public_base_url:
+            return self.public_base_url + path
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': path}, ExpiresIn=config.S3_DOWNLOAD_URL_EXPIRES
+        )
+
+
+_storage = None
+_storage_pid = None
+_storage_lock = threading.Lock()
+
+
+def create_storage():
+    if config.STORAGE_BACKEND == 's3':
+        return S3Storage(
+            bucket=config.S3_BUCKET,
+            endpoint_url=config.S3_ENDPOINT_URL or None,
+            region=config.S3_REGION or None,
+            access_key=config.S3_ACCESS_KEY or None,
+            secret_key=config.S3_SECRET_KEY or None,
+            public_base_url=config.S3_PUBLIC_BASE_URL or None
+        )
+    return LocalStorage(config.UPLOAD_FOLDER)
+
+
+def get_storage():
+    """按进程创建的存储后端（boto3 客户端不能跨 fork 复用）"""
+    global _storage, _storage_pid
+    if _storage is None or _storage_pid != os.getpid():
+        with _storage_lock:
+            if _storage is None or _storage_pid != os.getpid():
+                _storage = create_storage()
+                _storage_pid = os.getpid()
+    return _storage
+
+
+# ==================== 地址 ====================
+
+def url_for_path(path):
+    return URL_PREFIX + path
+
+
+def path_from_url(url):
+    """上传文件URL转为相对上传目录的路径，不是上传文件返回None"""
+    if not url or not url.startswith(URL_PREFIX):
+        return None
+    return url[len(URL_PREFIX):]
+
+
+def content_digest(path):
+    """按内容寻址的路径（<哈希>.<扩展名>，含其衍生版本）中的 sha256，随机名等其他路径返回None"""
+    digest = os.path.basename(path).split('.', 1)[0]
+    if len(digest) != 64 or digest.strip('0123456789abcdef'):
+        return None
+    return digest
+
+
+def _normalize_extension(filename):
+    ext = os.path.splitext(filename or '')[1].lower()
+    if ext not in ALLOWED_EXTENSIONS:
+        return None
+    return '.jpg' if ext == '.jpeg' else ext
+
+
+def content_type_for(path):
+    return CONTENT_TYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+
+
+# ==================== 经应用上传 ====================
+
+def _spool_to_temp(stream, tmp_dir):
+    """分块写入临时文件并计算哈希，返回 (临时文件路径, sha256, 字节数)"""
+    if tmp_dir:
+        os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+
+def save_file(file, folder, refs=1):
+    """
+    保存上传文件，内容已存在时直接复用
+    :param file: werkzeug FileStorage
+    :param folder: 存储目录，如 pickup_photos、avatars
+    :param refs: 本次新增的引用数（如一张合照被多条记录使用）
+    :return: 文件URL，不支持的文件类型返回None
+    """
+    ext = _normalize_extension(file.filename)
+    if not ext:
+        return None
+
+    storage = get_storage()
+    tmp_path, sha256, size = _spool_to_temp(file.stream, storage.tmp_dir)
+    path = f"{folder}/{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}"
+    try:
+        # 先增加引用再检查文件：持有引用后清理不会再删除该文件
+        _add_refs_waiting_for_cleanup(path, sha256, size, refs)
+        if storage.exists(path):
+            logger.info(f"上传文件内容已存在，复用: {path}")
+        else:
+            try:
+                storage.put_file(tmp_path, path, CONTENT_TYPES[ext])
+            except Exception:
+                release_stored_file_refs(path, refs)
+                raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return url_for_path(path)
+
+
+def _add_refs_waiting_for_cleanup(path, sha256, size, refs):
+    """
+    增加引用；相同内容的文件正在被清理时等待清理完成（随后重新保存文件）
+    :raises RuntimeError: 等待超时
+    """
+    deadline = time.monotonic() + STORED_FILE_DELETING_TIMEOUT
+    while True:
+        try:
+            if add_stored_file_refs(path, sha256, size, refs):
+                return
+        except Exception as e:
+            # 没有引用记录的文件不会被清理，只是无法回收
+            logger.error(f"记录文件引用失败: {e}")
+            return
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"等待文件清理完成超时: {path}")
+        time.sleep(0.2)
+
+
+# ==================== 直传 ====================
+
+def create_direct_upload(folder, filename):
+    """
+    申请直传地址
+    预先登记引用数为0的文件记录：上传后一直未被业务使用的文件会在保留期后被清理
+    :return: {'key', 'url', 'fields', 'expires_in'}，不支持的目录或文件类型返回None
+    """
+    ext = _normalize_extension(filename)
+    if folder not in UPLOAD_FOLDERS or not ext:
+        return None
+    path = f"{folder}/{DIRECT_UPLOAD_DIR}/{uuid.uuid4().hex}{ext}"
+    expires_in = config.DIRECT_UPLOAD_EXPIRES
+    upload = get_storage().presign_upload(path, CONTENT_TYPES[ext], config.MAX_CONTENT_LENGTH, expires_in)
+    add_stored_file_refs(path, '', 0, 0)
+    return dict(upload, key=path, expires_in=expires_in)
+
+
+def receive_direct_upload(key, token, file):
+    """
+    本地存储的直传接收（对应对象存储的签名POST上传）
+    :return: 是否保存成功
+    """
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage) or not key or not token or not file:
+        return False
+    claims = storage.verify_upload_token(token, config.DIRECT_UPLOAD_EXPIRES)
+    if not claims or claims['key'] != key or storage.exists(key):
+        return False
+    tmp_path, _, size = _spool_to_temp(file.stream, storage.tmp_dir)
+    try:
+        if 0 < size <= claims['max_size']:
+            storage.put_file(tmp_path, key, claims['content_type'])
+            return True
+        return False
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def claim_direct_upload(key, folder, refs=1):
+    """
+    业务接口使用直传文件：校验key由本服务签发、文件已上传且大小合规，然后增加引用
+    :return: 文件URL，校验失败返回None
+    """
+    if not key or not key.startswith(f"{folder}/{DIRECT_UPLOAD_DIR}/") or '..' in key:
+        return None
+    if get_stored_file(key) is None:
+        return None
+    size = get_storage().size(key)
+    if not size or size > config.MAX_CONTENT_LENGTH:
+        return None
+    # 未被使用的直传文件超过保留期正在被清理
+    if not add_stored_file_refs(key, '', size, refs):
+        return None
+    return url_for_path(key)
+
+
+# ==================== 引用与清理 ====================
+
+def release_file(url, count=1):
+    """文件不再被某条数据引用时调用（如头像被替换、记录写入失败）"""
+    path = path_from_url(url)
+    if not path:
+        return
+    try:
+        release_stored_file_refs(path, count)
+    except Exception as e:
+        logger.error(f"释放文件引用失败: {e}")
+
+
+def cleanup_unreferenced_files(grace_seconds=None, batch_size=500):
+    """
+    删除引用数为0且超过保留期的文件及其衍生版本
+    :return: 删除的文件数
+    """
+    from wxcloudrun.renditions import derived_paths
+
+    if grace_seconds is None:
+        grace_seconds = config.STORAGE_CLEANUP_GRACE_SECONDS
+    before = datetime.now() - timedelta(seconds=grace_seconds)
+    storage = get_storage()
+    deleted = 0
+    while True:
+        paths = get_unreferenced_stored_files(before, batch_size)
+        for path in paths:
+            # 先把仍未被引用的记录标记为清理中（此后不能增加引用），删除文件后再删除记录；
+            # 期间被重新引用时条件更新不生效，文件保留；上传相同内容会等待记录删除后重新保存文件
+            if not mark_stored_file_deleting(path):
+                continue
+            for file_path in [path] + derived_paths(path):
+                storage.delete(file_path)
+            delete_stored_file_record(path)
+            deleted += 1
+        if len(paths) < batch_size:
+            return deleted
@@ -0,0 +1,145 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import config
+from wxcloudrun.dao import get_wechat_token, acquire_wechat_token_lease, save_wechat_token, \
+    release_wechat_token_lease, expire_wechat_token
+
+logger = logging.getLogger('log')
+
+
+class AccessTokenStore:
+    """
+    微信access_token共享存储
+    - 进程内缓存token及过期时间，临近过期前提前刷新
+    - 进程内通过锁保证同一时间只有一个线程刷新
+    - 跨进程/容器通过数据库租约保证同一时间只有一方调用微信接口，其他方等待并读取新token
+    """
+
+    def __init__(self, appid, fetch_func):
+        """
+        :param appid: 公众号appid
+        :param fetch_func: 向微信获取token的函数，返回 (access_token, expires_in秒数)，失败返回None；
+                           抛出的异常（如 CallRejected）释放租约后原样抛给调用方
+        """
+        self.appid = appid
+        self.fetch_func = fetch_func
+        self.refresh_ahead = config.WECHAT_TOKEN_REFRESH_AHEAD
+        self.lease_seconds = config.WECHAT_TOKEN_LEASE_SECONDS
+        self.wait_seconds = config.WECHAT_TOKEN_WAIT_SECONDS
+
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = None
+        self._invalid_token = None
+
+    def _is_fresh(self, expires_at):
+        return expires_at is not None and expires_at - timedelta(seconds=self.refresh_ahead) > datetime.now()
+
+    def _is_usable(self, expires_at):
+        return expires_at is not None and expires_at > datetime.now()
+
+    def get(self):
+        """获取可用的access_token，失败返回None；fetch_func 抛出的异常原样抛出"""
+        token, expires_at = self._token, self._expires_at
+        if token and self._is_fresh(expires_at):
+            return token
+
+        with self._lock:
+            # 等锁期间其他线程可能已经刷新
+            if self._token and self._is_fresh(self._expires_at):
+                return self._token
+            return self._refresh()
+
+    def invalidate(self, access_token):
+        """微信返回token无效（40001/42001）时调用，下次获取会重新刷新"""
+        with self._lock:
+            self._invalid_token = access_token
+            if self._token == access_token:
+                self._token = None
+                self._expires_at = None
+        try:
+            expire_wechat_token(self.appid, access_token)
+        except Exception as e:
+            logger.error(f"标记access_token失效失败: {e}")
+
+    def _remember(self, token, expires_at):
+        self._token = token
+        self._expires_at = expires_at
+        return token
+
+    def _load_shared(self):
+        try:
+            shared = get_wechat_token(self.appid)
+        except Exception as e:
+            logger.error(f"读取共享access_token失败: {e}")
+            return None
+        if shared is None or shared[0] == self._invalid_token:
+            return None
+        return shared
+
+    def _fetch(self):
+        result = self.fetch_func()
+        if not result:
+            return None
+        token, expires_in = result
+        return token, datetime.now() + timedelta(seconds=expires_in)
+
+    def _new_owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"[-64:]
+
+    def _refresh(self):
+        shared = self._load_shared()
+        if shared and self._is_fresh(shared[1]):
+            return self._remember(*shared)
+
+        # 租约被其他进程持有时不自行获取（新token会使对方刚获取的token失效），等待对方写入；
+        # 对方异常退出、租约过期后，轮询中的下一次抢占会成功并由本进程刷新
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            owner = self._new_owner()
+            try:
+                leased = acquire_wechat_token_lease(self.appid, owner, self.lease_seconds)
+            except Exception as e:
+                # 数据库不可用时退化为进程内刷新
+                logger.error(f"抢占access_token租约失败: {e}")
+                fetched = self._fetch()
+                return self._remember(*fetched) if fetched else None
+            if leased:
+                return self._refresh_with_lease(owner)
+
+            # 其他进程正在刷新：旧token尚未过期则先继续使用
+            if shared and self._is_usable(shared[1]):
+                return self._remember(*shared)
+            if time.monotonic() >= deadline:
+                logger.error("等待共享access_token刷新超时")
+                return None
+            time.sleep(0.2)
+            shared = self._load_shared()
+            if shared and self._is_fresh(shared[1]):
+                return self._remember(*shared)
+
+    def _refresh_with_lease(self, owner):
+        try:
+            fetched = self._fetch()
+        except Exception:
+            release_wechat_token_lease(self.appid, owner)
+            raise
+        if not fetched:
+            release_wechat_token_lease(self.appid, owner)
+            return None
+        if save_wechat_token(self.appid, owner, fetched[0], fetched[1]):
+            logger.info("access_token已刷新")
+            return self._remember(*fetched)
+
+        # 获取期间租约过期，其他进程可能已经刷新并保存：以库中的token为准
+        logger.error("access_token租约已过期，新获取的token未保存，改用共享token")
+        shared = self._load_shared()
+        if shared and self._is_usable(shared[1]):
+            return self._remember(*shared)
+        return self._remember(*fetched)
@@ -1,12 +1,23 @@
 import os
+import json
+import base64
 import hashlib
 import logging
-import requests
 import xml.etree.ElementTree as ET
+from datetime import datetime
 from functools import wraps
-from flask import request
-from wxcloudrun.response import make_err_response
-from wxcloudrun.dao import get_parent_by_openid, get_teacher_by_openid, get_admin_by_username
+from flask import request, current_app, Response
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+import config
+from wxcloudrun.response import make_err_response, make_succ_response
+from wxcloudrun.cache import TTLCache
+from wxcloudrun.compression import etag_variants
+from wxcloudrun.dao import get_identities_by_openid
+from wxcloudrun.http_client import wechat_http
+from wxcloudrun.resilience import CallRejected, get_wechat_guard
+from wxcloudrun.storage import save_file, release_file, claim_direct_upload
+from wxcloudrun.renditions import schedule_renditions, rendition_urls
+from wxcloudrun.token_store import AccessTokenStore
 
 logger = logging.getLogger('log')
 
@@ -20,6 +31,125 @@ def get_openid_from_request():
     return request.headers.get('X-WX-OPENID', request.headers.get('X-WX-FROM-OPENID', None))
 
 
+class Identity:
+    """已认证的小程序用户身份（来自身份缓存或会话令牌，只读）"""
+
+    __slots__ = ('role', 'id', 'openid', 'token_version', '_profile')
+
+    def __init__(self, role, user_id, openid, profile=None, token_version=0):
+        self.role = role
+        self.id = user_id
+        self.openid = openid
+        self.token_version = token_version
+        self._profile = profile
+
+    @property
+    def profile(self):
+        """用户信息，构造时未提供的在首次访问时才查询"""
+        if self._profile is None:
+            identity = resolve_identities(self.openid).get(self.role)
+            self._profile = identity.profile if identity and identity.id == self.id else {}
+        return self._profile
+
+    @property
+    def name(self):
+        return self.profile.get('name')
+
+    @property
+    def phone(self):
+        return self.profile.get('phone')
+
+    @property
+    def avatar_url(self):
+        return self.profile.get('avatar_url')
+
+
+identity_cache = TTLCache(config.IDENTITY_CACHE_MAX_SIZE)
+
+
+def resolve_identities(openid):
+    """
+    解析openid对应的身份，优先读取缓存，未命中时一次UNION查询家长和教师
+    未注册的openid也会缓存（较短有效期），避免重复查库
+    :return: {'parent': Identity, 'teacher': Identity}，不存在的角色不在字典中
+    """
+    hit, identities = identity_cache.get(openid)
+    if hit:
+        return identities
+
+    rows = get_identities_by_openid(openid)
+    if rows is None:
+        # 查询失败不缓存
+        return {}
+
+    identities = {}
+    for row in rows:
+        if row.role in identities:
+            continue
+        profile = serialize_parent(row) if row.role == 'parent' else serialize_teacher(row)
+        identities[row.role] = Identity(row.role, row.id, row.openid, profile, row.token_version)
+
+    ttl = config.IDENTITY_CACHE_TTL if identities else config.IDENTITY_CACHE_NEGATIVE_TTL
+    identity_cache.set(openid, identities, ttl)
+    return identities
+
+
+def invalidate_identity(openid):
+    """家长、教师信息变更后清除对应的身份缓存"""
+    if openid:
+        identity_cache.delete(openid)
+
+
+def _session_token_serializer():
+    return URLSafeTimedSerializer(
+        current_app.config['SECRET_KEY'],
+        salt=f"session-token-v{config.SESSION_TOKEN_VERSION}"
+    )
+
+
+def issue_session_token(identity):
+    """
+    为已登录用户签发会话令牌
+    携带角色、用户ID、openid 和用户的令牌版本，签发时间用于过期校验
+    """
+    return _session_token_serializer().dumps([identity.role, identity.id, identity.openid, identity.token_version])
+
+
+def verify_session_token(token):
+    """
+    校验会话令牌：签名、有效期，以及令牌版本与用户当前版本一致（被单独吊销的令牌失效）
+    用户当前版本来自身份缓存，通常不查询数据库
+    :return: Identity，令牌无效、过期或已吊销返回None
+    """
+    try:
+        role, user_id, openid, *rest = _session_token_serializer().loads(token, max_age=config.SESSION_TOKEN_TTL)
+    except (BadSignature, ValueError, TypeError):
+        return None
+    # 不带版本的旧令牌视为版本0
+    token_version = rest[0] if rest else 0
+    identity = resolve_identities(openid).get(role)
+    if identity is None or identity.id != user_id or identity.token_version != token_version:
+        return None
+    return identity
+
+
+def get_identity_from_token():
+    """
+    从 Authorization: Bearer <token> 请求头解析身份
+    令牌中的openid与云托管注入的openid不一致时忽略令牌
+    """
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return None
+    identity = verify_session_token(auth_header[7:].strip())
+    if identity is None:
+        return None
+    openid = get_openid_from_request()
+    if openid and openid != identity.openid:
+        return None
+    return identity
+
+
 def require_auth(role=None):
     """
     认证装饰器，验证用户身份
@@ -28,37 +158,38 @@ def require_auth(role=None):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
+            if role == 'admin':
+                return make_err_response('管理员需要通过Web界面登录')
+
+            # 有效的会话令牌直接确定身份，无需查库
+            identity = get_identity_from_token()
+            if identity and (role is None or identity.role == role):
+                request.current_user = identity
+                request.user_role = identity.role
+                return f(*args, **kwargs)
+
             openid = get_openid_from_request()
 
             if not openid:
                 return make_err_response('未授权访问')
 
+            identities = resolve_identities(openid)
             if role == 'parent':
-                parent = get_parent_by_openid(openid)
-                if not parent:
+                identity = identities.get('parent')
+                if not identity:
                     return make_err_response('家长身份验证失败')
-                request.current_user = parent
-                request.user_role = 'parent'
             elif role == 'teacher':
-                teacher = get_teacher_by_openid(openid)
-                if not teacher:
+                identity = identities.get('teacher')
+                if not identity:
                     return make_err_response('教师身份验证失败')
-                request.current_user = teacher
-                request.user_role = 'teacher'
-            elif role == 'admin':
-                return make_err_response('管理员需要通过Web界面登录')
             else:
-                parent = get_parent_by_openid(openid)
-                teacher = get_teacher_by_openid(openid)
-                if parent:
-                    request.current_user = parent
-                    request.user_role = 'parent'
-                elif teacher:
-                    request.current_user = teacher
-                    request.user_role = 'teacher'
-                else:
+                identity = identities.get('parent') or identities.get('teacher')
+                if not identity:
                     return make_err_response('用户身份验证失败')
 
+            request.current_user = identity
+            request.user_role = identity.role
+
             return f(*args, **kwargs)
         return decorated_function
     return decorator
@@ -82,27 +213,67 @@ def require_admin_auth(f):
 class WeChatAPI:
     """微信公众号API封装"""
 
+    # access_token 无效或已过期的错误码
+    TOKEN_INVALID_ERRCODES = (40001, 42001)
+    # 微信系统繁忙，计入熔断失败
+    BUSY_ERRCODES = (-1,)
+    # 调用频率超限
+    THROTTLED_ERRCODES = (45011,)
+
     def __init__(self, appid, secret):
         self.appid = appid
         self.secret = secret
-        self.access_token = None
+        self.token_store = AccessTokenStore(appid, self.fetch_access_token)
 
-    def get_access_token(self):
-        """获取access_token"""
+    @property
+    def access_token(self):
+        return self.token_store.get()
+
+    def fetch_access_token(self):
+        """
+        向微信请求新的access_token
+        :return: (access_token, expires_in)，失败返回None
+        :raises CallRejected: 熔断或限流时抛出，由发送方推迟消息而不是计为一次发送失败
+        """
         url = f"https://api.weixin.qq.com/cgi-bin/token?grant_type=client_credential&appid={self.appid}&secret={self.secret}"
+        guard = get_wechat_guard('token')
         try:
-            response = requests.get(url, timeout=10)
-            data = response.json()
-            if 'access_token' in data:
-                self.access_token = data['access_token']
-                return self.access_token
-            else:
-                logger.error(f"获取access_token失败: {data}")
-                return None
+            with guard.call():
+                data = wechat_http.get(url).json()
+        except CallRejected as e:
+            logger.error(f"获取access_token被拒绝: {e}")
+            raise
         except Exception as e:
             logger.error(f"获取access_token异常: {e}")
             return None
 
+        if 'access_token' in data:
+            guard.record_success()
+            return data['access_token'], data.get('expires_in', 7200)
+        errcode = data.get('errcode')
+        self.record_result(guard, errcode)
+        logger.error(f"获取access_token失败: {data}")
+        if errcode in self.THROTTLED_ERRCODES:
+            raise CallRejected(guard.name, 'rate_limited', config.WECHAT_THROTTLE_PAUSE_SECONDS)
+        return None
+
+    @classmethod
+    def record_result(cls, guard, errcode):
+        """按微信返回的错误码更新接口保护状态：频率限制暂停调用，系统繁忙计为失败，其他业务错误说明接口可用"""
+        if errcode in cls.THROTTLED_ERRCODES:
+            guard.throttled()
+        elif errcode in cls.BUSY_ERRCODES:
+            guard.record_failure()
+        else:
+            guard.record_success()
+
+    def get_access_token(self):
+        """
+        获取access_token（优先使用共享缓存，临近过期时刷新）
+        :raises CallRejected: 需要刷新而获取token的接口被熔断或限流时抛出
+        """
+        return self.token_store.get()
+
     def send_template_message(self, openid, template_id, data, miniprogram=None):
         """
         发送模板消息
@@ -110,12 +281,8 @@ class WeChatAPI:
         :param template_id: 模板ID
         :param data: 模板数据
         :param miniprogram: 小程序信息 {'appid': '', 'pagepath': ''}
+        :raises CallRejected: 发送或获取access_token被熔断、限流时立即抛出，调用方应稍后重试
         """
-        if not self.access_token:
-            self.get_access_token()
-
-        url = f"https://api.weixin.qq.com/cgi-bin/message/template/send?access_token={self.access_token}"
-
         payload = {
             "touser": openid,
             "template_id": template_id,
@@ -125,18 +292,39 @@ class WeChatAPI:
         if miniprogram:
             payload["miniprogram"] = miniprogram
 
-        try:
-            response = requests.post(url, json=payload, timeout=10)
-            result = response.json()
-            if result.get('errcode') == 0:
+        guard = get_wechat_guard('template_send')
+        # token被其他进程刷新导致失效时，重新获取后自动重试一次
+        for attempt in range(2):
+            access_token = self.get_access_token()
+            if not access_token:
+                logger.error("模板消息发送失败: 无可用access_token")
+                return False
+
+            url = f"https://api.weixin.qq.com/cgi-bin/message/template/send?access_token={access_token}"
+            try:
+                with guard.call():
+                    result = wechat_http.post(url, json=payload).json()
+            except CallRejected:
+                raise
+            except Exception as e:
+                logger.error(f"模板消息发送异常: {e}")
+                return False
+
+            errcode = result.get('errcode')
+            self.record_result(guard, errcode)
+            if errcode in self.THROTTLED_ERRCODES:
+                logger.error(f"模板消息发送触发频率限制: {result}")
+                raise CallRejected(guard.name, 'rate_limited', config.WECHAT_THROTTLE_PAUSE_SECONDS)
+            if errcode == 0:
                 logger.info(f"模板消息发送成功: {openid}")
                 return True
-            else:
-                logger.error(f"模板消息发送失败: {result}")
-                return False
-        except Exception as e:
-            logger.error(f"模板消息发送异常: {e}")
+            if errcode in self.TOKEN_INVALID_ERRCODES and attempt == 0:
+                logger.info(f"access_token已失效({errcode})，刷新后重试")
+                self.token_store.invalidate(access_token)
+                continue
+            logger.error(f"模板消息发送失败: {result}")
             return False
+        return False
 
 
 def parse_wechat_xml(xml_data):
@@ -163,37 +351,142 @@ def verify_wechat_signature(signature, timestamp, nonce, token):
 
 # ==================== File Upload ====================
 
-def upload_file_to_storage(file, folder='pickup_photos'):
+def upload_file_to_storage(file, folder='pickup_photos', refs=1):
     """
-    上传文件到对象存储
-    这里使用本地存储作为示例，实际应该使用云存储服务
+    上传文件到存储，按内容哈希命名，相同内容只保存一份
+    保存后在后台生成缩略图等衍生版本，衍生版本地址用 rendition_urls 获取
+    :param refs: 本次新增的引用数
     """
     try:
-        if not file:
+        if not file or not file.filename:
             return None
+        url = save_file(file, folder, refs)
+        if url:
+            schedule_renditions(url)
+        return url
+    except Exception as e:
+        logger.error(f"文件上传失败: {e}")
+        return None
 
-        filename = file.filename
-        if not filename:
-            return None
 
-        ext = os.path.splitext(filename)[1]
-        if ext.lower() not in ['.jpg', '.jpeg', '.png', '.gif']:
-            return None
+def claim_uploaded_file(key, folder='pickup_photos', refs=1):
+    """
+    使用客户端直传到存储的文件（/api/uploads/presign 返回的 key）
+    :return: 文件URL，key 无效或文件未上传返回None
+    """
+    try:
+        url = claim_direct_upload(key, folder, refs)
+        if url:
+            schedule_renditions(url)
+        return url
+    except Exception as e:
+        logger.error(f"使用直传文件失败: {e}")
+        return None
 
-        import uuid
-        unique_filename = f"{uuid.uuid4().hex}{ext}"
 
-        upload_folder = os.path.join('uploads', folder)
-        os.makedirs(upload_folder, exist_ok=True)
+def has_request_upload(name):
+    """请求中是否提供了文件：multipart 文件字段 <name> 或直传文件key字段 <name>_key"""
+    return bool(request.files.get(name) or request.form.get(f'{name}_key'))
 
-        file_path = os.path.join(upload_folder, unique_filename)
-        file.save(file_path)
 
-        file_url = f"/uploads/{folder}/{unique_filename}"
-        return file_url
+def save_request_upload(name, folder='pickup_photos', refs=1):
+    """
+    保存请求中的文件，multipart 文件优先，其次为直传文件key
+    :return: 文件URL，失败返回None
+    """
+    file = request.files.get(name)
+    if file:
+        return upload_file_to_storage(file, folder, refs)
+    return claim_uploaded_file(request.form.get(f'{name}_key'), folder, refs)
+
+
+# ==================== Conditional Responses ====================
+
+def conditional_response(version, build_data):
+    """
+    带 ETag 的成功响应
+    ETag 由请求路径参数、当前用户和数据版本计算，客户端 If-None-Match 命中时直接返回304，
+    不再查询列表数据和序列化
+    :param version: 数据版本（get_*_version 的结果），为None时不做条件响应
+    :param build_data: 生成响应数据的函数
+    """
+    if version is None:
+        return make_succ_response(build_data())
+
+    user = getattr(request, 'current_user', None)
+    etag_source = repr((request.full_path, getattr(user, 'role', None), getattr(user, 'id', None), version))
+    etag = hashlib.sha1(etag_source.encode('utf-8')).hexdigest()
+
+    # 客户端缓存的可能是压缩后的表示，其ETag带有编码后缀
+    matched = next((tag for tag in etag_variants(etag) if request.if_none_match.contains_weak(tag)), None)
+    if matched:
+        response = Response(status=304)
+        response.set_etag(matched)
+    else:
+        response = make_succ_response(build_data())
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# ==================== Pagination ====================
+
+def encode_cursor(*values):
+    """将游标值编码为不透明字符串"""
+    parts = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(parts, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, *types):
+    """
+    解码游标
+    :param types: 每个游标值的类型（datetime 或 int）
+    :raises ValueError: 游标格式错误
+    """
+    try:
+        parts = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(parts, list) or len(parts) != len(types):
+            raise ValueError('cursor length mismatch')
+        return tuple(datetime.fromisoformat(v) if t is datetime else t(v) for v, t in zip(parts, types))
     except Exception as e:
-        logger.error(f"文件上传失败: {e}")
-        return None
+        raise ValueError(f"invalid cursor: {e}")
+
+
+def get_page_args(*cursor_types):
+    """
+    解析分页参数 page_size 和 cursor
+    :return: (page_size, cursor)，未传 page_size 时均为 None，接口按不分页的旧格式返回
+    :raises ValueError: 游标格式错误
+    """
+    page_size = request.args.get('page_size', type=int)
+    if not page_size:
+        return None, None
+    page_size = max(1, min(page_size, config.PAGE_SIZE_MAX))
+    cursor = request.args.get('cursor')
+    return page_size, decode_cursor(cursor, *cursor_types) if cursor else None
+
+
+def make_page(items, page_size, serialize, cursor_key):
+    """
+    生成分页结果 {'items': [...], 'next_cursor': ...}
+    :param items: 查询结果，需多查一条（page_size + 1）用于判断是否有下一页
+    :param cursor_key: 从最后一条数据取游标值的函数
+    """
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    return {
+        'items': [serialize(item) for item in items],
+        'next_cursor': encode_cursor(*cursor_key(items[-1])) if has_more else None
+    }
+
+
+def pickup_record_cursor_key(record):
+    return record.pickup_time, record.id
+
+
+def id_cursor_key(obj):
+    return (obj.id,)
 
 
 # ==================== Data Serialization ====================
@@ -223,6 +516,7 @@ def serialize_parent(parent):
         'name': parent.name,
         'phone': parent.phone,
         'avatar_url': parent.avatar_url,
+        'avatar_thumb_url': parent.avatar_thumb_url,
         'created_at': parent.created_at.strftime('%Y-%m-%d %H:%M:%S') if parent.created_at else None
     }
 
@@ -237,6 +531,7 @@ def serialize_teacher(teacher):
         'name': teacher.name,
         'phone': teacher.phone,
         'avatar_url': teacher.avatar_url,
+        'avatar_thumb_url': teacher.avatar_thumb_url,
         'created_at': teacher.created_at.strftime('%Y-%m-%d %H:%M:%S') if teacher.created_at else None
     }
 
@@ -252,7 +547,76 @@ def serialize_pickup_record(record):
         'teacher_id': record.teacher_id,
         'teacher': serialize_teacher(record.teacher) if hasattr(record, 'teacher') else None,
         'photo_url': record.photo_url,
+        'photo_thumb_url': record.photo_thumb_url,
+        'photo_medium_url': record.photo_medium_url,
+        'photo_full_url': record.photo_full_url,
         'pickup_time': record.pickup_time.strftime('%Y-%m-%d %H:%M:%S') if record.pickup_time else None,
         'notes': record.notes,
         'created_at': record.created_at.strftime('%Y-%m-%d %H:%M:%S') if record.created_at else None
     }
+
+
+# ==================== Row Serialization ====================
+# 与上面的 serialize_* 输出完全相同的结构，用于 get_*_rows 返回的行元组
+
+def format_datetime(value):
+    """格式化为 YYYY-mm-dd HH:MM:SS（isoformat 比 strftime 快得多）"""
+    return value.isoformat(' ', 'seconds') if value else None
+
+
+def serialize_student_row(row):
+    return {
+        'id': row.id,
+        'name': row.name,
+        'student_number': row.student_number,
+        'class_name': row.class_name,
+        'grade': row.grade,
+        'avatar_url': row.avatar_url,
+        'created_at': format_datetime(row.created_at)
+    }
+
+
+def serialize_user_row(row):
+    """家长、教师行（字段相同）"""
+    return {
+        'id': row.id,
+        'openid': row.openid,
+        'name': row.name,
+        'phone': row.phone,
+        'avatar_url': row.avatar_url,
+        'avatar_thumb_url': row.avatar_thumb_url,
+        'created_at': format_datetime(row.created_at)
+    }
+
+
+def serialize_pickup_record_row(row):
+    return {
+        'id': row.id,
+        'student_id': row.student_id,
+        'student': {
+            'id': row.s_id,
+            'name': row.s_name,
+            'student_number': row.s_student_number,
+            'class_name': row.s_class_name,
+            'grade': row.s_grade,
+            'avatar_url': row.s_avatar_url,
+            'created_at': format_datetime(row.s_created_at)
+        } if row.s_id is not None else None,
+        'teacher_id': row.teacher_id,
+        'teacher': {
+            'id': row.t_id,
+            'openid': row.t_openid,
+            'name': row.t_name,
+            'phone': row.t_phone,
+            'avatar_url': row.t_avatar_url,
+            'avatar_thumb_url': row.t_avatar_thumb_url,
+            'created_at': format_datetime(row.t_created_at)
+        } if row.t_id is not None else None,
+        'photo_url': row.photo_url,
+        'photo_thumb_url': row.photo_thumb_url,
+        'photo_medium_url': row.photo_medium_url,
+        'photo_full_url': row.photo_full_url,
+        'pickup_time': format_datetime(row.pickup_time),
+        'notes': row.notes,
+        'created_at': format_datetime(row.created_at)
+    }
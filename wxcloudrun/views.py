@@ -1,13 +1,27 @@
-from datetime import datetime
-from flask import render_template, request, session
+from datetime import datetime, timedelta
+from flask import render_template, request, session, Response, stream_with_context, send_from_directory, abort, \
+    redirect
+from werkzeug.security import safe_join
 from run import app
 from wxcloudrun.dao import *
+from wxcloudrun.bulk_import import IMPORT_SPECS, IMPORT_MODES, parse_import_file, import_records
+from wxcloudrun.export import iter_csv, iter_ndjson
+from wxcloudrun.idempotency import idempotent
 from wxcloudrun.model import *
-from wxcloudrun.response import make_succ_empty_response, make_succ_response, make_err_response
+from wxcloudrun.outbox import OutboxDispatcher
+from wxcloudrun.pubsub import PickupBroker, BrokerFull
+from wxcloudrun.renditions import ensure_rendition, is_rendition_ready, parse_rendition_path
+from wxcloudrun.resilience import CallRejected, get_wechat_guard, wechat_guard_stats
+from wxcloudrun.storage import get_storage, create_direct_upload, receive_direct_upload, content_digest
+from wxcloudrun.response import make_succ_empty_response, make_succ_response, make_err_response, json_dumps
 from wxcloudrun.utils import *
+import config
 import logging
 import json
+import mimetypes
 import os
+import socket
+import time
 
 logger = logging.getLogger('log')
 
@@ -21,6 +35,83 @@ MINIPROGRAM_APPID = os.environ.get('MINIPROGRAM_APPID', '')
 wechat_api = WeChatAPI(WECHAT_APPID, WECHAT_SECRET)
 
 
+def send_outbox_message(openid, template_id, payload):
+    """发件箱消息发送函数"""
+    return wechat_api.send_template_message(
+        openid,
+        template_id,
+        payload['data'],
+        payload.get('miniprogram')
+    )
+
+
+def build_pickup_payload(records):
+    """
+    接送通知的模板消息内容
+    :param records: 接送信息列表 [{'record_id', 'student_name', 'teacher_name', 'pickup_time'}]，多条时合并为一条通知
+    """
+    student_names = '、'.join(dict.fromkeys(r['student_name'] for r in records))
+    teacher_names = '、'.join(dict.fromkeys(r['teacher_name'] for r in records))
+    record_ids = ','.join(str(r['record_id']) for r in records)
+    if len(records) == 1:
+        pagepath = f'pages/pickup-detail/index?id={record_ids}'
+    else:
+        pagepath = f'pages/pickup-detail/index?ids={record_ids}'
+    template_data = {
+        'first': {'value': f'{student_names}已被接走', 'color': '#173177'},
+        'keyword1': {'value': student_names, 'color': '#173177'},
+        'keyword2': {'value': max(r['pickup_time'] for r in records), 'color': '#173177'},
+        'keyword3': {'value': teacher_names, 'color': '#173177'},
+        'remark': {'value': '点击查看接送照片', 'color': '#173177'}
+    }
+    return {
+        'data': template_data,
+        'miniprogram': {'appid': MINIPROGRAM_APPID, 'pagepath': pagepath},
+        'coalesce': records
+    }
+
+
+def merge_pickup_notifications(payloads):
+    """合并发给同一家长的多条接送通知（如兄弟姐妹先后被接走）"""
+    records = [record for payload in payloads for record in payload['coalesce']]
+    records.sort(key=lambda r: (r['pickup_time'], r['record_id']))
+    return build_pickup_payload(records)
+
+
+outbox_dispatcher = OutboxDispatcher(app, send_outbox_message, merge_pickup_notifications)
+
+# 家长实时推送（长轮询 / SSE）的进程内订阅代理
+pickup_broker = PickupBroker(app)
+
+
+@app.before_first_request
+def start_outbox_dispatcher():
+    """首个请求到达时启动通知分发器，补发重启前未完成的消息"""
+    outbox_dispatcher.start()
+
+
+def build_pickup_notifications(student, teacher, pickup_record, parents):
+    """
+    为接送记录生成发给各家长的通知发件箱消息
+    消息延迟 NOTIFY_COALESCE_WINDOW_SECONDS 发送，窗口内同一家长的其他接送通知合并为一条
+    """
+    payload = json.dumps(build_pickup_payload([{
+        'record_id': pickup_record.id,
+        'student_name': student.name,
+        'teacher_name': teacher.name,
+        'pickup_time': pickup_record.pickup_time.strftime('%Y-%m-%d %H:%M:%S')
+    }]), ensure_ascii=False)
+    next_attempt_at = datetime.now() + timedelta(seconds=config.NOTIFY_COALESCE_WINDOW_SECONDS)
+    return [NotificationOutbox(
+        pickup_record_id=pickup_record.id,
+        openid=parent.openid,
+        template_id=TEMPLATE_ID,
+        payload=payload,
+        coalesce_key=f'pickup:{parent.openid}',
+        next_attempt_at=next_attempt_at
+    ) for parent in parents]
+
+
 @app.route('/')
 def index():
     """
@@ -77,13 +168,18 @@ def admin_logout():
 def admin_get_students():
     """获取所有学生列表"""
     try:
-        class_name = request.args.get('class_name')
-        if class_name:
-            students = get_students_by_class(class_name)
-        else:
-            students = get_all_students()
+        try:
+            page_size, cursor = get_page_args(int)
+        except ValueError:
+            return make_err_response('分页参数无效')
+        after_id = cursor[0] if cursor else None
+        limit = page_size + 1 if page_size else None
+
+        students = get_student_rows(request.args.get('class_name'), limit, after_id)
 
-        return make_succ_response([serialize_student(s) for s in students])
+        if page_size:
+            return make_succ_response(make_page(students, page_size, serialize_student_row, id_cursor_key))
+        return make_succ_response([serialize_student_row(s) for s in students])
     except Exception as e:
         logger.error(f"获取学生列表失败: {e}")
         return make_err_response('获取学生列表失败')
@@ -91,6 +187,7 @@ def admin_get_students():
 
 @app.route('/api/admin/students', methods=['POST'])
 @require_admin_auth
+@idempotent
 def admin_create_student():
     """创建学生"""
     try:
@@ -125,6 +222,7 @@ def admin_create_student():
 
 @app.route('/api/admin/students/<int:student_id>', methods=['PUT'])
 @require_admin_auth
+@idempotent
 def admin_update_student(student_id):
     """更新学生信息"""
     try:
@@ -151,6 +249,7 @@ def admin_update_student(student_id):
 
 @app.route('/api/admin/students/<int:student_id>', methods=['DELETE'])
 @require_admin_auth
+@idempotent
 def admin_delete_student(student_id):
     """删除学生"""
     try:
@@ -169,8 +268,16 @@ def admin_delete_student(student_id):
 def admin_get_parents():
     """获取所有家长列表"""
     try:
-        parents = get_all_parents()
-        return make_succ_response([serialize_parent(p) for p in parents])
+        try:
+            page_size, cursor = get_page_args(int)
+        except ValueError:
+            return make_err_response('分页参数无效')
+        if page_size:
+            parents = get_parent_rows(page_size + 1, cursor[0] if cursor else None)
+            return make_succ_response(make_page(parents, page_size, serialize_user_row, id_cursor_key))
+
+        parents = get_parent_rows()
+        return make_succ_response([serialize_user_row(p) for p in parents])
     except Exception as e:
         logger.error(f"获取家长列表失败: {e}")
         return make_err_response('获取家长列表失败')
@@ -178,6 +285,7 @@ def admin_get_parents():
 
 @app.route('/api/admin/parents', methods=['POST'])
 @require_admin_auth
+@idempotent
 def admin_create_parent():
     """创建家长"""
     try:
@@ -195,6 +303,7 @@ def admin_create_parent():
 
         parent = Parent(openid=openid, name=name, phone=phone)
         parent = create_parent(parent)
+        invalidate_identity(openid)
 
         return make_succ_response(serialize_parent(parent))
     except Exception as e:
@@ -207,8 +316,16 @@ def admin_create_parent():
 def admin_get_teachers():
     """获取所有教师列表"""
     try:
-        teachers = get_all_teachers()
-        return make_succ_response([serialize_teacher(t) for t in teachers])
+        try:
+            page_size, cursor = get_page_args(int)
+        except ValueError:
+            return make_err_response('分页参数无效')
+        if page_size:
+            teachers = get_teacher_rows(page_size + 1, cursor[0] if cursor else None)
+            return make_succ_response(make_page(teachers, page_size, serialize_user_row, id_cursor_key))
+
+        teachers = get_teacher_rows()
+        return make_succ_response([serialize_user_row(t) for t in teachers])
     except Exception as e:
         logger.error(f"获取教师列表失败: {e}")
         return make_err_response('获取教师列表失败')
@@ -216,6 +333,7 @@ def admin_get_teachers():
 
 @app.route('/api/admin/teachers', methods=['POST'])
 @require_admin_auth
+@idempotent
 def admin_create_teacher():
     """创建教师"""
     try:
@@ -233,6 +351,7 @@ def admin_create_teacher():
 
         teacher = Teacher(openid=openid, name=name, phone=phone)
         teacher = create_teacher(teacher)
+        invalidate_identity(openid)
 
         return make_succ_response(serialize_teacher(teacher))
     except Exception as e:
@@ -242,6 +361,7 @@ def admin_create_teacher():
 
 @app.route('/api/admin/parent-student', methods=['POST'])
 @require_admin_auth
+@idempotent
 def admin_bind_parent_student():
     """绑定家长和学生关系"""
     try:
@@ -268,8 +388,33 @@ def admin_bind_parent_student():
         return make_err_response('绑定失败')
 
 
+@app.route('/api/admin/sessions/revoke', methods=['POST'])
+@require_admin_auth
+@idempotent
+def admin_revoke_sessions():
+    """吊销单个家长或教师已签发的全部会话令牌（如移除教师、家长账号被盗用）"""
+    try:
+        params = request.get_json() or {}
+        role = params.get('role')
+        user_id = params.get('user_id')
+
+        model = {'parent': Parent, 'teacher': Teacher}.get(role)
+        if not model or not user_id:
+            return make_err_response('角色必须为parent或teacher，用户ID不能为空')
+
+        openid = revoke_session_tokens(model, user_id)
+        if openid is None:
+            return make_err_response('用户不存在')
+        invalidate_identity(openid)
+        return make_succ_empty_response()
+    except Exception as e:
+        logger.error(f"吊销会话令牌失败: {e}")
+        return make_err_response('吊销失败')
+
+
 @app.route('/api/admin/parent-student', methods=['DELETE'])
 @require_admin_auth
+@idempotent
 def admin_unbind_parent_student():
     """解绑家长和学生关系"""
     try:
@@ -281,12 +426,98 @@ def admin_unbind_parent_student():
             return make_err_response('家长ID和学生ID不能为空')
 
         delete_parent_student_relation(parent_id, student_id)
+        # 解绑后吊销家长已签发的会话令牌，重新登录时按新的绑定关系认证
+        invalidate_identity(revoke_session_tokens(Parent, parent_id))
         return make_succ_empty_response()
     except Exception as e:
         logger.error(f"解绑家长学生关系失败: {e}")
         return make_err_response('解绑失败')
 
 
+@app.route('/api/admin/pickup-records/export', methods=['GET'])
+@require_admin_auth
+def admin_export_pickup_records():
+    """
+    流式导出接送记录
+    查询参数: start_date、end_date（YYYY-MM-DD，含结束日）、format（csv/ndjson）、class_name、teacher_id（可选）
+    """
+    try:
+        start_date = datetime.strptime(request.args.get('start_date', ''), '%Y-%m-%d')
+        end_date = datetime.strptime(request.args.get('end_date', ''), '%Y-%m-%d')
+    except ValueError:
+        return make_err_response('日期格式错误，应为YYYY-MM-DD')
+    if end_date < start_date:
+        return make_err_response('结束日期不能早于开始日期')
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return make_err_response('导出格式只支持csv或ndjson')
+
+    batches = iter_pickup_record_export_rows(
+        start_date,
+        end_date + timedelta(days=1),
+        class_name=request.args.get('class_name'),
+        teacher_id=request.args.get('teacher_id', type=int),
+        batch_size=config.EXPORT_BATCH_SIZE
+    )
+    if export_format == 'csv':
+        body, mimetype = iter_csv(batches), 'text/csv'
+    else:
+        body, mimetype = iter_ndjson(batches), 'application/x-ndjson'
+
+    filename = f"pickup_records_{start_date:%Y%m%d}_{end_date:%Y%m%d}.{export_format}"
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@app.route('/api/admin/import/<kind>', methods=['POST'])
+@require_admin_auth
+@idempotent
+def admin_bulk_import(kind):
+    """
+    批量导入学生、家长、教师或绑定关系
+    kind: students / parents / teachers / bindings
+    上传 multipart 文件 file（.csv 或 .json），或提交 JSON {"records": [...]}
+    查询参数 mode: upsert（默认，已存在则更新）或 insert（已存在的行报错）
+    """
+    try:
+        if kind not in IMPORT_SPECS:
+            return make_err_response('不支持的导入类型')
+        mode = request.args.get('mode', 'upsert')
+        if mode not in IMPORT_MODES:
+            return make_err_response('导入模式只支持upsert或insert')
+
+        upload = request.files.get('file')
+        try:
+            if upload:
+                file_format = os.path.splitext(upload.filename or '')[1].lower().lstrip('.')
+                records = parse_import_file(upload.read(), file_format)
+            else:
+                params = request.get_json(silent=True) or {}
+                records = params.get('records')
+                if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+                    return make_err_response('导入数据不能为空')
+        except ValueError as e:
+            return make_err_response(str(e))
+
+        return make_succ_response(import_records(kind, records, mode))
+    except Exception as e:
+        logger.error(f"批量导入失败: {e}")
+        return make_err_response('批量导入失败')
+
+
+@app.route('/api/admin/wechat/health', methods=['GET'])
+@require_admin_auth
+def admin_wechat_health():
+    """微信接口熔断器和限流器状态（当前工作进程）"""
+    return make_succ_response({
+        'worker': f"{socket.gethostname()}:{os.getpid()}",
+        'endpoints': wechat_guard_stats()
+    })
+
+
 # ==================== 教师接口 ====================
 
 @app.route('/api/teacher/students', methods=['GET'])
@@ -294,13 +525,21 @@ def admin_unbind_parent_student():
 def teacher_get_students():
     """教师获取学生列表"""
     try:
+        try:
+            page_size, cursor = get_page_args(int)
+        except ValueError:
+            return make_err_response('分页参数无效')
+        after_id = cursor[0] if cursor else None
+        limit = page_size + 1 if page_size else None
         class_name = request.args.get('class_name')
-        if class_name:
-            students = get_students_by_class(class_name)
-        else:
-            students = get_all_students()
 
-        return make_succ_response([serialize_student(s) for s in students])
+        def build_data():
+            students = get_student_rows(class_name, limit, after_id)
+            if page_size:
+                return make_page(students, page_size, serialize_student_row, id_cursor_key)
+            return [serialize_student_row(s) for s in students]
+
+        return conditional_response(get_students_version(class_name), build_data)
     except Exception as e:
         logger.error(f"获取学生列表失败: {e}")
         return make_err_response('获取学生列表失败')
@@ -308,55 +547,51 @@ def teacher_get_students():
 
 @app.route('/api/teacher/pickup-records', methods=['POST'])
 @require_auth('teacher')
+@idempotent
 def teacher_create_pickup_record():
     """教师创建接送记录"""
     try:
         student_id = request.form.get('student_id')
         notes = request.form.get('notes', '')
-        photo = request.files.get('photo')
 
         if not student_id:
             return make_err_response('学生ID不能为空')
 
-        if not photo:
+        if not has_request_upload('photo'):
             return make_err_response('照片不能为空')
 
         student = get_student_by_id(int(student_id))
         if not student:
             return make_err_response('学生不存在')
 
-        photo_url = upload_file_to_storage(photo)
+        photo_url = save_request_upload('photo')
         if not photo_url:
             return make_err_response('照片上传失败')
 
         teacher = request.current_user
+        parents = get_parents_by_student_id(student.id)
+        renditions = rendition_urls(photo_url)
         pickup_record = PickupRecord(
             student_id=student.id,
             teacher_id=teacher.id,
             photo_url=photo_url,
-            notes=notes
+            photo_thumb_url=renditions.get('thumb'),
+            photo_medium_url=renditions.get('medium'),
+            photo_full_url=renditions.get('full'),
+            notes=notes,
+            pickup_time=datetime.now()
         )
-        pickup_record = create_pickup_record(pickup_record)
-
-        parents = get_parents_by_student_id(student.id)
-        for parent in parents:
-            miniprogram_data = {
-                'appid': MINIPROGRAM_APPID,
-                'pagepath': f'pages/pickup-detail/index?id={pickup_record.id}'
-            }
-            template_data = {
-                'first': {'value': f'{student.name}已被接走', 'color': '#173177'},
-                'keyword1': {'value': student.name, 'color': '#173177'},
-                'keyword2': {'value': pickup_record.pickup_time.strftime('%Y-%m-%d %H:%M:%S'), 'color': '#173177'},
-                'keyword3': {'value': teacher.name, 'color': '#173177'},
-                'remark': {'value': '点击查看接送照片', 'color': '#173177'}
-            }
-            wechat_api.send_template_message(
-                parent.openid,
-                TEMPLATE_ID,
-                template_data,
-                miniprogram_data
+        # 记录与通知消息同事务提交，由后台分发器异步发送，不阻塞教师请求
+        try:
+            pickup_record = create_pickup_record_with_notifications(
+                pickup_record,
+                lambda record: build_pickup_notifications(student, teacher, record, parents)
             )
+        except Exception:
+            release_file(photo_url)
+            raise
+        outbox_dispatcher.wake(config.NOTIFY_COALESCE_WINDOW_SECONDS)
+        pickup_broker.publish([student.id])
 
         return make_succ_response(serialize_pickup_record(pickup_record))
     except Exception as e:
@@ -364,14 +599,114 @@ def teacher_create_pickup_record():
         return make_err_response('创建接送记录失败')
 
 
+@app.route('/api/teacher/pickup-records/batch', methods=['POST'])
+@require_auth('teacher')
+@idempotent
+def teacher_batch_create_pickup_records():
+    """
+    教师批量创建接送记录（整班放学）
+    student_ids: 学生ID，逗号分隔或重复提交
+    photo: 合照，所有学生共用；也可用 photo_<学生ID> 为每个学生单独上传照片，单独照片优先
+    照片字段也可以改为提交直传文件的key：photo_key、photo_<学生ID>_key
+    """
+    try:
+        notes = request.form.get('notes', '')
+        try:
+            student_ids = list(dict.fromkeys(
+                int(student_id) for value in request.form.getlist('student_ids')
+                for student_id in value.split(',') if student_id.strip()
+            ))
+        except ValueError:
+            return make_err_response('学生ID无效')
+
+        if not student_ids:
+            return make_err_response('学生ID不能为空')
+        if len(student_ids) > config.PICKUP_BATCH_MAX_SIZE:
+            return make_err_response(f'单次最多{config.PICKUP_BATCH_MAX_SIZE}名学生')
+
+        shared_photo = 'photo' if has_request_upload('photo') else None
+        photos = {student_id: f'photo_{student_id}' if has_request_upload(f'photo_{student_id}') else shared_photo
+                  for student_id in student_ids}
+        missing_photo = [str(student_id) for student_id, photo in photos.items() if not photo]
+        if missing_photo:
+            return make_err_response(f"照片不能为空: {','.join(missing_photo)}")
+
+        students = get_students_by_ids(student_ids)
+        if students is None:
+            return make_err_response('批量创建接送记录失败')
+        students = {student.id: student for student in students}
+        missing_student = [str(student_id) for student_id in student_ids if student_id not in students]
+        if missing_student:
+            return make_err_response(f"学生不存在: {','.join(missing_student)}")
+
+        guardians = get_parents_by_student_ids(student_ids)
+        if guardians is None:
+            return make_err_response('批量创建接送记录失败')
+
+        # 合照只保存一次，所有学生共用同一个地址，引用数为使用它的学生数
+        photo_refs = {}
+        for photo in photos.values():
+            photo_refs[photo] = photo_refs.get(photo, 0) + 1
+        photo_urls = {}
+        for photo in photos.values():
+            if photo not in photo_urls:
+                photo_urls[photo] = save_request_upload(photo, refs=photo_refs[photo])
+                if not photo_urls[photo]:
+                    for name, url in photo_urls.items():
+                        release_file(url, photo_refs[name])
+                    return make_err_response('照片上传失败')
+
+        teacher = request.current_user
+        pickup_time = datetime.now()
+        renditions = {name: rendition_urls(url) for name, url in photo_urls.items()}
+        pickup_records = [PickupRecord(
+            student_id=student_id,
+            teacher_id=teacher.id,
+            photo_url=photo_urls[photos[student_id]],
+            photo_thumb_url=renditions[photos[student_id]].get('thumb'),
+            photo_medium_url=renditions[photos[student_id]].get('medium'),
+            photo_full_url=renditions[photos[student_id]].get('full'),
+            notes=notes,
+            pickup_time=pickup_time
+        ) for student_id in student_ids]
+        # 所有记录与通知消息同一事务提交，由后台分发器异步发送
+        try:
+            pickup_records = create_pickup_records_with_notifications(
+                pickup_records,
+                lambda record: build_pickup_notifications(
+                    students[record.student_id], teacher, record, guardians[record.student_id])
+            )
+        except Exception:
+            for name, url in photo_urls.items():
+                release_file(url, photo_refs[name])
+            raise
+        outbox_dispatcher.wake(config.NOTIFY_COALESCE_WINDOW_SECONDS)
+        pickup_broker.publish(student_ids)
+
+        records = get_pickup_records_by_ids([record.id for record in pickup_records])
+        return make_succ_response([serialize_pickup_record(record) for record in records])
+    except Exception as e:
+        logger.error(f"批量创建接送记录失败: {e}")
+        return make_err_response('批量创建接送记录失败')
+
+
 @app.route('/api/teacher/pickup-records', methods=['GET'])
 @require_auth('teacher')
 def teacher_get_pickup_records():
     """教师获取接送记录列表"""
     try:
+        try:
+            page_size, cursor = get_page_args(datetime, int)
+        except ValueError:
+            return make_err_response('分页参数无效')
+        if page_size:
+            records = get_pickup_record_rows(page_size + 1, cursor)
+            return make_succ_response(make_page(records, page_size, serialize_pickup_record_row,
+                                                pickup_record_cursor_key))
+
         limit = request.args.get('limit', type=int)
-        records = get_all_pickup_records(limit)
-        return make_succ_response([serialize_pickup_record(r) for r in records])
+        records = get_pickup_record_rows(limit)
+        return make_succ_response([serialize_pickup_record_row(r) for r in records])
     except Exception as e:
         logger.error(f"获取接送记录失败: {e}")
         return make_err_response('获取接送记录失败')
@@ -382,20 +717,23 @@ def teacher_get_pickup_records():
 def teacher_upload_avatar():
     """教师上传头像"""
     try:
-        teacher = request.current_user
-        avatar = request.files.get('avatar')
-
-        if not avatar:
+        teacher = get_teacher_by_id(request.current_user.id)
+        if not has_request_upload('avatar'):
             return make_err_response('头像文件不能为空')
 
-        avatar_url = upload_file_to_storage(avatar, folder='avatars')
+        avatar_url = save_request_upload('avatar', folder='avatars')
         if not avatar_url:
             return make_err_response('头像上传失败')
 
+        old_avatar_url = teacher.avatar_url
         teacher.avatar_url = avatar_url
+        teacher.avatar_thumb_url = rendition_urls(avatar_url).get('thumb')
         teacher = update_teacher(teacher)
+        invalidate_identity(teacher.openid)
+        if old_avatar_url != avatar_url:
+            release_file(old_avatar_url)
 
-        return make_succ_response({'avatar_url': avatar_url})
+        return make_succ_response({'avatar_url': avatar_url, 'avatar_thumb_url': teacher.avatar_thumb_url})
     except Exception as e:
         logger.error(f"上传头像失败: {e}")
         return make_err_response('上传头像失败')
@@ -409,8 +747,10 @@ def parent_get_students():
     """家长获取自己的学生列表"""
     try:
         parent = request.current_user
-        students = get_students_by_parent_id(parent.id)
-        return make_succ_response([serialize_student(s) for s in students])
+        return conditional_response(
+            get_parent_students_version(parent.id),
+            lambda: [serialize_student(s) for s in get_students_by_parent_id(parent.id)]
+        )
     except Exception as e:
         logger.error(f"获取学生列表失败: {e}")
         return make_err_response('获取学生列表失败')
@@ -422,9 +762,20 @@ def parent_get_pickup_records():
     """家长获取接送记录"""
     try:
         parent = request.current_user
+        try:
+            page_size, cursor = get_page_args(datetime, int)
+        except ValueError:
+            return make_err_response('分页参数无效')
         limit = request.args.get('limit', type=int)
-        records = get_pickup_records_by_parent_openid(parent.openid, limit)
-        return make_succ_response([serialize_pickup_record(r) for r in records])
+
+        def build_data():
+            if page_size:
+                records = get_pickup_record_rows(page_size + 1, cursor, parent_id=parent.id)
+                return make_page(records, page_size, serialize_pickup_record_row, pickup_record_cursor_key)
+            records = get_pickup_record_rows(limit, parent_id=parent.id)
+            return [serialize_pickup_record_row(r) for r in records]
+
+        return conditional_response(get_parent_feed_version(parent.id), build_data)
     except Exception as e:
         logger.error(f"获取接送记录失败: {e}")
         return make_err_response('获取接送记录失败')
@@ -441,8 +792,7 @@ def parent_get_pickup_record_detail(record_id):
         if not record:
             return make_err_response('记录不存在')
 
-        student_ids = [s.id for s in get_students_by_parent_id(parent.id)]
-        if record.student_id not in student_ids:
+        if not is_parent_of_student(parent.id, record.student_id):
             return make_err_response('无权访问该记录')
 
         return make_succ_response(serialize_pickup_record(record))
@@ -451,25 +801,163 @@ def parent_get_pickup_record_detail(record_id):
         return make_err_response('获取接送记录详情失败')
 
 
+@app.route('/api/parent/pickup-records/batch', methods=['GET'])
+@require_auth('parent')
+def parent_get_pickup_records_batch():
+    """
+    家长批量获取接送记录详情（合并通知跳转的多记录页面）
+    查询参数: ids，记录ID，逗号分隔
+    """
+    try:
+        parent = request.current_user
+        try:
+            record_ids = list(dict.fromkeys(
+                int(record_id) for record_id in request.args.get('ids', '').split(',') if record_id.strip()
+            ))
+        except ValueError:
+            return make_err_response('记录ID无效')
+        if not record_ids:
+            return make_err_response('记录ID不能为空')
+        if len(record_ids) > config.PICKUP_BATCH_MAX_SIZE:
+            return make_err_response(f'单次最多{config.PICKUP_BATCH_MAX_SIZE}条记录')
+
+        student_ids = {student.id for student in get_students_by_parent_id(parent.id)}
+        records = [record for record in get_pickup_records_by_ids(record_ids) if record.student_id in student_ids]
+        return make_succ_response([serialize_pickup_record(record) for record in records])
+    except Exception as e:
+        logger.error(f"批量获取接送记录详情失败: {e}")
+        return make_err_response('获取接送记录详情失败')
+
+
+def make_push_busy_response():
+    """等待连接数达到 PUSH_MAX_CONNECTIONS 时返回503，不再占用线程，客户端按 Retry-After 重试或改为查询列表"""
+    response = make_err_response('连接数过多，请稍后重试')
+    response.status_code = 503
+    response.headers['Retry-After'] = str(config.PUSH_RETRY_AFTER_SECONDS)
+    return response
+
+
+def wait_for_pickup_record_rows(subscription, parent_id, since, timeout):
+    """
+    查询家长ID大于 since 的接送记录，没有时等待订阅被唤醒后重新查询，直到有记录或超时
+    先订阅再查询：查询之后提交的记录一定会唤醒订阅，不会漏掉
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        rows = get_pickup_record_rows_after(parent_id, since)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            return rows
+        subscription.wait(remaining)
+
+
+@app.route('/api/parent/pickup-records/poll', methods=['GET'])
+@require_auth('parent')
+def parent_poll_pickup_records():
+    """
+    长轮询等待新的接送记录
+    查询参数: since（上次返回的 cursor，首次不传时立即返回当前游标）、timeout（最长等待秒数，不超过 PUSH_LONG_POLL_TIMEOUT）
+    返回数据: {'records': 新记录（按ID升序）, 'cursor': 下次请求的 since}
+    """
+    try:
+        parent = request.current_user
+        since = request.args.get('since', type=int)
+        if since is None:
+            return make_succ_response({'records': [], 'cursor': get_max_pickup_record_id()})
+        timeout = min(request.args.get('timeout', config.PUSH_LONG_POLL_TIMEOUT, type=float),
+                      config.PUSH_LONG_POLL_TIMEOUT)
+
+        student_ids = [student.id for student in get_students_by_parent_id(parent.id)]
+        subscription = pickup_broker.subscribe(student_ids)
+        try:
+            rows = wait_for_pickup_record_rows(subscription, parent.id, since, max(timeout, 0))
+        finally:
+            pickup_broker.unsubscribe(subscription)
+
+        return make_succ_response({
+            'records': [serialize_pickup_record_row(row) for row in rows],
+            'cursor': rows[-1].id if rows else since
+        })
+    except BrokerFull:
+        return make_push_busy_response()
+    except Exception as e:
+        logger.error(f"等待接送记录失败: {e}")
+        return make_err_response('获取接送记录失败')
+
+
+@app.route('/api/parent/pickup-records/stream', methods=['GET'])
+@require_auth('parent')
+def parent_stream_pickup_records():
+    """
+    SSE推送新的接送记录
+    每条记录为一个 pickup 事件，事件ID为记录ID；断线重连时通过 Last-Event-ID（或查询参数 since）从上次的位置继续
+    连接保持 PUSH_SSE_MAX_DURATION 秒后由服务端结束，客户端自动重连
+    """
+    try:
+        parent = request.current_user
+        since = request.headers.get('Last-Event-ID', type=int)
+        if since is None:
+            since = request.args.get('since', type=int)
+        if since is None:
+            since = get_max_pickup_record_id()
+
+        student_ids = [student.id for student in get_students_by_parent_id(parent.id)]
+        subscription = pickup_broker.subscribe(student_ids)
+    except BrokerFull:
+        return make_push_busy_response()
+    except Exception as e:
+        logger.error(f"建立接送记录推送失败: {e}")
+        return make_err_response('建立推送连接失败')
+
+    def events():
+        cursor = since
+        deadline = time.monotonic() + config.PUSH_SSE_MAX_DURATION
+        yield 'retry: 3000\n\n'
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            rows = wait_for_pickup_record_rows(subscription, parent.id, cursor,
+                                               min(config.PUSH_SSE_HEARTBEAT_SECONDS, remaining))
+            if not rows:
+                yield ': keepalive\n\n'
+                continue
+            for row in rows:
+                cursor = row.id
+                data = json_dumps(serialize_pickup_record_row(row)).decode('utf-8')
+                yield f'id: {row.id}\nevent: pickup\ndata: {data}\n\n'
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # 连接结束（包括客户端断开）时注销订阅
+    response.call_on_close(lambda: pickup_broker.unsubscribe(subscription))
+    return response
+
+
 @app.route('/api/parent/avatar', methods=['POST'])
 @require_auth('parent')
 def parent_upload_avatar():
     """家长上传头像"""
     try:
-        parent = request.current_user
-        avatar = request.files.get('avatar')
-
-        if not avatar:
+        parent = get_parent_by_id(request.current_user.id)
+        if not has_request_upload('avatar'):
             return make_err_response('头像文件不能为空')
 
-        avatar_url = upload_file_to_storage(avatar, folder='avatars')
+        avatar_url = save_request_upload('avatar', folder='avatars')
         if not avatar_url:
             return make_err_response('头像上传失败')
 
+        old_avatar_url = parent.avatar_url
         parent.avatar_url = avatar_url
+        parent.avatar_thumb_url = rendition_urls(avatar_url).get('thumb')
         parent = update_parent(parent)
+        invalidate_identity(parent.openid)
+        if old_avatar_url != avatar_url:
+            release_file(old_avatar_url)
 
-        return make_succ_response({'avatar_url': avatar_url})
+        return make_succ_response({'avatar_url': avatar_url, 'avatar_thumb_url': parent.avatar_thumb_url})
     except Exception as e:
         logger.error(f"上传头像失败: {e}")
         return make_err_response('上传头像失败')
@@ -483,12 +971,15 @@ def wechat_login():
     
     请求参数:
         code: 微信小程序 wx.login() 获取的 code
+        issue_token: 是否签发会话令牌（可选）
     
     返回数据:
         openid: 用户openid
         role: 用户角色 ('parent' 或 'teacher')
         user: 用户信息对象
         is_new_user: 是否为新用户（仅新用户返回）
+        token: 会话令牌，后续请求通过 Authorization: Bearer <token> 携带（仅 issue_token 时返回）
+        token_expires_in: 令牌有效期（秒）
     """
     try:
         params = request.get_json()
@@ -496,6 +987,7 @@ def wechat_login():
             return make_err_response('请求参数不能为空')
         
         code = params.get('code') 
+        issue_token = bool(params.get('issue_token'))
 
         if not code:
             return make_err_response('code不能为空')
@@ -512,18 +1004,20 @@ def wechat_login():
 
             import requests as http_requests
             url = 'https://api.weixin.qq.com/sns/jscode2session'
+            guard = get_wechat_guard('jscode2session')
             try:
-                response = http_requests.get(url, params={
-                    'appid': MINIPROGRAM_APPID,
-                    'secret': miniprogram_secret,
-                    'js_code': code,
-                    'grant_type': 'authorization_code'
-                }, timeout=10, verify=False)
-
-                data = response.json()
+                with guard.call():
+                    response = wechat_http.get(url, params={
+                        'appid': MINIPROGRAM_APPID,
+                        'secret': miniprogram_secret,
+                        'js_code': code,
+                        'grant_type': 'authorization_code'
+                    })
+                    data = response.json()
+                WeChatAPI.record_result(guard, data.get('errcode'))
                 
                 # 检查微信API返回的错误
-                if 'errcode' in data:
+                if data.get('errcode'):
                     error_msg = data.get('errmsg', '未知错误')
                     logger.error(f"微信登录API错误: errcode={data['errcode']}, errmsg={error_msg}")
                     if data['errcode'] == 40029:
@@ -541,6 +1035,9 @@ def wechat_login():
                 session_key = data.get('session_key', '')
                 logger.info(f"成功获取openid: {openid[:10]}...")
                 
+            except CallRejected as e:
+                logger.error(f"微信登录被拒绝: {e}")
+                return make_err_response('登录服务繁忙，请稍后再试')
             except http_requests.exceptions.Timeout:
                 logger.error("微信API请求超时")
                 return make_err_response('网络请求超时，请稍后重试')
@@ -553,39 +1050,41 @@ def wechat_login():
 
         # 检查用户是否已存在
         try:
-            parent = get_parent_by_openid(openid)
-            teacher = get_teacher_by_openid(openid)
+            identities = resolve_identities(openid)
         except Exception as e:
             logger.error(f"查询用户信息失败: {e}")
             return make_err_response('查询用户信息失败')
 
+        def login_response(identity, **extra):
+            data = {
+                'openid': openid,
+                'role': identity.role,
+                'user': identity.profile
+            }
+            if issue_token:
+                data['token'] = issue_session_token(identity)
+                data['token_expires_in'] = config.SESSION_TOKEN_TTL
+            data.update(extra)
+            return make_succ_response(data)
+
+        parent = identities.get('parent')
+        teacher = identities.get('teacher')
         if parent:
             logger.info(f"家长用户登录: {openid[:10]}...")
-            return make_succ_response({
-                'openid': openid,
-                'role': 'parent',
-                'user': serialize_parent(parent)
-            })
+            return login_response(parent)
         elif teacher:
             logger.info(f"教师用户登录: {openid[:10]}...")
-            return make_succ_response({
-                'openid': openid,
-                'role': 'teacher',
-                'user': serialize_teacher(teacher)
-            })
+            return login_response(teacher)
         else:
             # 新用户，自动创建家长账号
             try:
                 new_parent = Parent(openid=openid)
                 new_parent = create_parent(new_parent)
+                invalidate_identity(openid)
                 logger.info(f"新用户登录，创建家长账号: {openid[:10]}...")
                 
-                return make_succ_response({
-                    'openid': openid,
-                    'role': 'parent',
-                    'user': serialize_parent(new_parent),
-                    'is_new_user': True
-                })
+                identity = Identity('parent', new_parent.id, openid, serialize_parent(new_parent))
+                return login_response(identity, is_new_user=True)
             except Exception as e:
                 logger.error(f"创建新用户失败: {e}")
                 return make_err_response('创建用户失败，请稍后重试')
@@ -603,15 +1102,10 @@ def get_user_info():
         user = request.current_user
         role = request.user_role
 
-        if role == 'parent':
+        if role in ('parent', 'teacher'):
             return make_succ_response({
-                'role': 'parent',
-                'user': serialize_parent(user)
-            })
-        elif role == 'teacher':
-            return make_succ_response({
-                'role': 'teacher',
-                'user': serialize_teacher(user)
+                'role': role,
+                'user': user.profile
             })
         else:
             return make_err_response('用户角色未知')
@@ -653,6 +1147,7 @@ def wechat_callback():
                 if not existing_parent:
                     parent = Parent(openid=openid)
                     create_parent(parent)
+                    invalidate_identity(openid)
                     logger.info(f"新用户关注，创建家长记录: {openid}")
 
             return 'success'
@@ -663,11 +1158,101 @@ def wechat_callback():
 
 # ==================== 静态文件服务 ====================
 
+# 上传文件按内容哈希或随机名命名，同一地址的内容不会变化，可以长期缓存
+UPLOADS_MAX_AGE = 365 * 24 * 3600
+
+
+def _upload_etag(filename):
+    """
+    按内容寻址的文件直接用路径中的内容哈希作强ETag（衍生版本再加上版本名），
+    不随文件 mtime 变化，多实例、重新部署后仍一致；随机名的历史文件返回None，使用 Werkzeug 默认ETag
+    """
+    digest = content_digest(filename)
+    if not digest:
+        return None
+    rendition = parse_rendition_path(filename)
+    return f"{digest}.{rendition[1]}" if rendition else digest
+
+
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    """提供上传文件访问"""
-    from flask import send_from_directory
-    return send_from_directory('uploads', filename)
+    """
+    提供上传文件访问：长期缓存、强ETag、Range
+    UPLOADS_OFFLOAD 为 x-accel / x-sendfile 时只返回响应头，由前置代理读取并发送文件
+    对象存储后端重定向到对象存储的下载地址
+    """
+    storage = get_storage()
+    download_url = storage.download_url(filename)
+    if download_url is not None:
+        # 衍生版本是否已生成记录在 stored_files 中，不向对象存储发 HEAD 请求；未生成时在此即时生成
+        if parse_rendition_path(filename) and not is_rendition_ready(filename) and not ensure_rendition(filename):
+            abort(404)
+        response = redirect(download_url)
+        response.cache_control.public = True
+        response.cache_control.max_age = UPLOADS_MAX_AGE if config.S3_PUBLIC_BASE_URL \
+            else config.S3_DOWNLOAD_URL_EXPIRES // 2
+        return response
+
+    full_path = safe_join(config.UPLOAD_FOLDER, filename)
+    if not full_path:
+        abort(404)
+    # 衍生版本尚未由后台生成时即时生成
+    if not os.path.isfile(full_path) and not ensure_rendition(filename):
+        abort(404)
+
+    etag = _upload_etag(filename)
+    if config.UPLOADS_OFFLOAD == 'x-accel':
+        if etag and request.if_none_match.contains(etag):
+            # 客户端缓存仍有效，直接返回304，不再交给 nginx 发送文件
+            response = Response(status=304)
+        else:
+            response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = config.UPLOADS_ACCEL_PREFIX.rstrip('/') + '/' + filename
+        if etag:
+            response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = UPLOADS_MAX_AGE
+    else:
+        # x-sendfile 模式由 Flask 的 USE_X_SENDFILE 配置生效
+        response = send_from_directory(config.UPLOAD_FOLDER, filename, max_age=UPLOADS_MAX_AGE,
+                                       etag=etag or True, conditional=True)
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/api/uploads/presign', methods=['POST'])
+@require_auth()
+def presign_upload():
+    """
+    申请直传地址，客户端把文件直接上传到存储，再用返回的 key 调用业务接口（如 photo_key、avatar_key）
+    参数：folder（pickup_photos / avatars）、filename（用于确定文件类型）
+    返回：key、url、fields（上传时以 multipart/form-data POST 到 url，附带 fields 及文件字段 file）、expires_in
+    """
+    try:
+        params = request.get_json(silent=True) or {}
+        folder = params.get('folder', 'pickup_photos')
+        if folder == 'pickup_photos' and request.user_role != 'teacher':
+            return make_err_response('教师身份验证失败')
+
+        upload = create_direct_upload(folder, params.get('filename'))
+        if not upload:
+            return make_err_response('不支持的目录或文件类型')
+        return make_succ_response(upload)
+    except Exception as e:
+        logger.error(f"申请直传地址失败: {e}")
+        return make_err_response('申请直传地址失败')
+
+
+@app.route('/api/uploads/direct', methods=['POST'])
+def direct_upload():
+    """本地存储的直传接收，表单为 presign 返回的 fields 及文件字段 file"""
+    try:
+        if not receive_direct_upload(request.form.get('key'), request.form.get('token'), request.files.get('file')):
+            return make_err_response('上传失败')
+        return make_succ_empty_response()
+    except Exception as e:
+        logger.error(f"直传文件失败: {e}")
+        return make_err_response('上传失败')
 
 
 # ==================== 旧接口保留 ====================